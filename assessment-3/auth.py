@@ -1,12 +1,15 @@
-import boto3
-import os
 import hmac
 import hashlib
 import base64
+import time
+import threading
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt
+from jose import jwt, jwk
+from jose.exceptions import JWTError
+from cachetools import TLRUCache
 from pydantic import BaseModel
+import config
 import requests
 import pyqrcode
 import io
@@ -15,39 +18,24 @@ import base64 as b64
 router = APIRouter(tags=["auth"])
 
 # ---------------- AWS CONFIG ----------------
-ssm = boto3.client("ssm", region_name="ap-southeast-2")
-secrets = boto3.client("secretsmanager", region_name="ap-southeast-2")
+def _apply_refresh(fresh: dict):
+    # Only the secret can usefully change under a running process
+    global CLIENT_SECRET
+    CLIENT_SECRET = fresh.get("client_secret")
 
-def get_param(name: str) -> str:
-    try:
-        resp = ssm.get_parameter(Name=name)
-        value = resp["Parameter"]["Value"]
-        print(f"[Parameter Store] Loaded {name}: {value}")
-        return value
-    except Exception as e:
-        print(f"[Parameter Store] Failed to load {name}: {e}")
-        return None
-
-REGION = get_param("/n10893997/aws_region")
-USER_POOL_ID = get_param("/n10893997/cognito_user_pool_id")
-CLIENT_ID = get_param("/n10893997/cognito_client_id")
-
-# CLIENT_SECRET from Secrets Manager or fallback .env
-try:
-    secret_name = "/n10893997/cognito_client_secret"
-    secret_resp = secrets.get_secret_value(SecretId=secret_name)
-    CLIENT_SECRET = secret_resp["SecretString"]
-    print(f"[Secrets Manager] Loaded {secret_name}")
-except Exception as e:
-    print(f"[Secrets Manager] Failed to load secret: {e}")
-    CLIENT_SECRET = os.getenv("COGNITO_CLIENT_SECRET")
+settings = config.bootstrap(on_refresh=_apply_refresh)
+REGION = settings.get("region")
+USER_POOL_ID = settings.get("user_pool_id")
+CLIENT_ID = settings.get("client_id")
+CLIENT_SECRET = settings.get("client_secret")
 
 print(f"[DEBUG] REGION={REGION}")
 print(f"[DEBUG] USER_POOL_ID={USER_POOL_ID}")
 print(f"[DEBUG] CLIENT_ID={CLIENT_ID}")
 print(f"[DEBUG] CLIENT_SECRET loaded? {'YES' if CLIENT_SECRET else 'NO'}")
 
-cognito_client = boto3.client("cognito-idp", region_name=REGION)
+# The user pool lives in the configured region, not necessarily the session default
+cognito_client = config.LazyClient("cognito-idp", REGION)
 
 # ---------------- Pydantic Schemas ----------------
 class SignupRequest(BaseModel):
@@ -281,17 +269,104 @@ def verify_mfa(req: VerifyMFARequest):
 # ---------------- TOKEN VERIFICATION ----------------
 bearer_scheme = HTTPBearer()
 JWKS_URL = f"https://cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}/.well-known/jwks.json"
-JWKS = requests.get(JWKS_URL).json()
+JWKS_MAX_AGE = 6 * 3600        # refetch the key set in the background after this long
+JWKS_MIN_REFRESH = 60          # unknown kids can't trigger refetches more often than this
+JWKS_REFRESH_WAIT = 5          # how long a request with an unknown kid waits for the refetch
+TOKEN_CACHE_SIZE = 4096
+
+
+class TokenVerifier:
+    """Verifies Cognito JWTs against the pool's JWKS.
+
+    Keys are parsed once and indexed by kid. Tokens that already verified are
+    remembered (by SHA-256 digest) until they expire, so repeat requests skip
+    the RSA check entirely. A token signed with a kid we don't know triggers a
+    single background JWKS refetch, which that request briefly waits for.
+    """
+
+    def __init__(self, jwks_url, audience, jwks=None):
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.keys = {}
+        # monotonic() of the last good fetch / last fetch attempt; None = never
+        self.loaded_at = None
+        self.attempted_at = None
+        self.lock = threading.Lock()
+        self.refreshing = None     # Event set when the in-flight refetch finishes
+        # Entries expire at the token's own exp claim
+        self.verified = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=lambda _k, claims, _now: claims["exp"], timer=time.time)
+        # Key set from config bootstrap; otherwise fetched on the first request
+        if jwks:
+            # Snapshot keys may be stale: loaded_at stays None so the first use refetches in the background
+            self._set_keys(jwks, fetched=False)
+
+    def _load(self):
+        resp = requests.get(self.jwks_url, timeout=5)
+        resp.raise_for_status()
+        self._set_keys(resp.json())
+
+    def _set_keys(self, jwks, fetched=True):
+        keys = {k["kid"]: jwk.construct(k, k.get("alg", "RS256")) for k in jwks.get("keys", [])}
+        with self.lock:
+            self.keys = keys
+            if fetched:
+                self.loaded_at = time.monotonic()
+        print(f"[AUTH] Loaded {len(keys)} signing key(s) from JWKS")
+
+    def _refresh(self) -> threading.Event:
+        """Start a background refetch unless one is running or ran too recently."""
+        with self.lock:
+            if self.refreshing and not self.refreshing.is_set():
+                return self.refreshing
+            done = threading.Event()
+            now = time.monotonic()
+            if self.attempted_at is not None and now - self.attempted_at < JWKS_MIN_REFRESH:
+                done.set()
+                return done
+            self.attempted_at = now
+            self.refreshing = done
+
+        def run():
+            try:
+                self._load()
+            except Exception as e:
+                print(f"[AUTH] JWKS refresh failed: {e}")
+            finally:
+                done.set()
+
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+        return done
+
+    def verify(self, token: str) -> dict:
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        with self.lock:
+            claims = self.verified.get(digest)
+        if claims is not None:
+            return claims
+
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > JWKS_MAX_AGE:
+            self._refresh()
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.keys.get(kid)
+        if key is None:
+            # Possibly a rotated key pool: wait (briefly) for one shared refetch
+            self._refresh().wait(JWKS_REFRESH_WAIT)
+            key = self.keys.get(kid)
+            if key is None:
+                raise JWTError(f"Unknown signing key {kid}")
+
+        claims = jwt.decode(token, key, algorithms=["RS256"], audience=self.audience)
+        if "exp" in claims:
+            with self.lock:
+                self.verified[digest] = claims
+        return claims
+
+
+verifier = TokenVerifier(JWKS_URL, CLIENT_ID, settings.get("jwks"))
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
     token = credentials.credentials
     try:
-        decoded = jwt.decode(
-            token,
-            JWKS,
-            algorithms=["RS256"],
-            audience=CLIENT_ID,
-        )
-        return decoded
+        return verifier.verify(token)
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
@@ -0,0 +1,148 @@
+"""Transcode benchmark for the worker's ffmpeg path.
+
+Generates a fixed set of synthetic sample clips, then runs worker.run_ffmpeg over
+a sweep of preset x CRF x threads x passes x concurrent jobs x chain mode. Every
+configuration runs in its own child process so CPU time and peak RSS of its
+ffmpeg children can be read from getrusage. Results are written as JSON lines.
+
+    python benchmark.py --presets slow,medium --crf 18,23 --threads 0,1 \\
+        --passes 1,3 --concurrency 1,2 --out bench_results.jsonl
+"""
+import argparse, itertools, json, os, platform, resource, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+# name -> (width, height, fps, seconds); deterministic lavfi sources
+SAMPLE_CLIPS = {
+    "360p": (640, 360, 30, 10),
+    "720p": (1280, 720, 30, 10),
+    "1080p": (1920, 1080, 30, 10),
+}
+
+
+def make_clip(name, work_dir):
+    """Create (once) a sample clip with moving test pattern and a tone."""
+    width, height, fps, seconds = SAMPLE_CLIPS[name]
+    path = os.path.join(work_dir, f"sample_{name}.mp4")
+    if not os.path.exists(path):
+        subprocess.run([
+            "ffmpeg", "-y", "-nostdin", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+            "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+            "-t", str(seconds),
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-b:a", "128k",
+            "-shortest",
+            path,
+        ], check=True)
+    return path
+
+
+def run_single(config):
+    """Child side: run one configuration through worker.run_ffmpeg and measure it."""
+    # worker reads its encoder settings from the environment at import time
+    os.environ.update({
+        "FFMPEG_PRESET": config["preset"],
+        "FFMPEG_CRF": str(config["crf"]),
+        "FFMPEG_THREADS": str(config["threads"]),
+        "TRANSCODE_PASSES": str(config["passes"]),
+        "TRANSCODE_MODE": config["mode"],
+        "METRICS_PORT": "0",
+    })
+    import worker
+
+    outputs = [
+        os.path.join(config["work_dir"], f"out_{os.getpid()}_{i}.mp4")
+        for i in range(config["concurrency"])
+    ]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=config["concurrency"]) as pool:
+        list(pool.map(lambda out: worker.run_ffmpeg(config["input"], out), outputs))
+    wall = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    _, _, fps, seconds = SAMPLE_CLIPS[config["clip"]]
+    frames = fps * seconds * config["concurrency"]
+    sizes = [os.path.getsize(out) for out in outputs]
+    for out in outputs:
+        os.remove(out)
+
+    return {
+        "wall_seconds": round(wall, 3),
+        "fps": round(frames / wall, 2),
+        "cpu_seconds": round((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime), 3),
+        # ru_maxrss is KB on Linux: the largest single ffmpeg process, not the sum
+        "peak_rss_mb": round(after.ru_maxrss / 1024, 1),
+        "output_bytes": sum(sizes) // len(sizes),
+    }
+
+
+def sweep(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    clips = {name: make_clip(name, args.work_dir) for name in args.clips}
+    host = {
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "ffmpeg": subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0],
+    }
+
+    grid = list(itertools.product(args.clips, args.modes, args.presets, args.crf, args.threads, args.passes, args.concurrency))
+    print(f"[BENCH] {len(grid)} configuration(s) x {args.repeat} run(s) → {args.out}")
+
+    with open(args.out, "a") as out:
+        for clip, mode, preset, crf, threads, passes, concurrency in grid:
+            config = {
+                "clip": clip, "mode": mode, "preset": preset, "crf": crf,
+                "threads": threads, "passes": passes, "concurrency": concurrency,
+                "input": clips[clip], "work_dir": args.work_dir,
+            }
+            for run in range(args.repeat):
+                child = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--single", json.dumps(config)],
+                    capture_output=True, text=True,
+                )
+                record = {k: v for k, v in config.items() if k not in ("input", "work_dir")}
+                record.update(host, run=run)
+                if child.returncode == 0:
+                    record.update(json.loads(child.stdout.strip().splitlines()[-1]))
+                else:
+                    record["error"] = child.stderr.strip()[-500:]
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                print(f"[BENCH] {json.dumps(record)}")
+
+
+def _csv(cast=str):
+    return lambda value: [cast(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the worker transcode path")
+    parser.add_argument("--clips", type=_csv(), default=["720p", "1080p"], help=f"from {', '.join(SAMPLE_CLIPS)}")
+    parser.add_argument("--modes", type=_csv(), default=["pipe"], help="pipe, files, single")
+    parser.add_argument("--presets", type=_csv(), default=["slow", "medium", "veryfast"])
+    parser.add_argument("--crf", type=_csv(int), default=[18, 23])
+    parser.add_argument("--threads", type=_csv(int), default=[0])
+    parser.add_argument("--passes", type=_csv(int), default=[1, 3])
+    parser.add_argument("--concurrency", type=_csv(int), default=[1, 2])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--work-dir", default="/tmp/transcode-bench")
+    parser.add_argument("--out", default="bench_results.jsonl")
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Worker prints go to stderr so stdout carries only the result line
+        real_stdout, sys.stdout = sys.stdout, sys.stderr
+        result = run_single(json.loads(args.single))
+        print(json.dumps(result), file=real_stdout)
+        return
+
+    unknown = set(args.clips) - set(SAMPLE_CLIPS)
+    if unknown:
+        parser.error(f"unknown clip(s): {', '.join(sorted(unknown))}")
+    sweep(args)
+
+
+if __name__ == "__main__":
+    main()
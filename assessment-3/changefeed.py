@@ -0,0 +1,264 @@
+import time, threading, asyncio, os, socket, uuid
+import config
+from boto3.dynamodb.types import TypeDeserializer
+
+SHARD_REFRESH_SECONDS = 30
+SUBSCRIBER_BUFFER = 500
+RETRY_MAX_SECONDS = 60
+
+# DynamoDB Streams throttles more than 2 concurrent readers per shard, so at
+# most this many API processes tail the stream, each holding a reader slot
+# lease. The others serve 503 on /jobs/events (clients poll GET /jobs) and
+# rely on the response cache TTL instead of feed-driven invalidation.
+MAX_STREAM_READERS = 2
+LEASE_TABLE = "n10893997-a3-leases"
+LEASE_SECONDS = 30
+
+
+class JobChangeFeed:
+    """Fans DynamoDB Stream records of the jobs table out to asyncio subscribers.
+
+    One background thread per API process tails every open shard of the
+    table's stream and turns each record into a small event:
+
+        created / deleted   a job row appeared or went away
+        status              the job's status changed
+        progress            the worker wrote a new progress record
+
+    Subscribers get their own queue, filtered to one owner (or everything for
+    admins). A subscriber that falls too far behind gets a single "resync"
+    event and should refetch instead of replaying.
+
+    Only a process holding one of the MAX_STREAM_READERS slot leases reads;
+    live() says whether this one currently does. Failures (including the
+    first describe_table) are retried with backoff, never fatal.
+    """
+
+    def __init__(self, table, attributes, poll_interval=1.0):
+        self.table = table
+        self.attributes = attributes
+        self.poll_interval = poll_interval
+        self.subscribers = {}   # queue -> (loop, owner or None for all)
+        self.listeners = []     # callbacks run on the reader thread before subscribers hear about it
+        self.lock = threading.Lock()
+        self.thread = None
+        self.seq = 0
+        self.arn = False        # unresolved; None once we know the table has no stream
+        self.reading = False    # holding a reader slot and tailing the stream
+        self.slot = None
+        self.reader_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def stream_arn(self):
+        """The table's stream ARN (looked up once), or None if streams aren't enabled."""
+        if self.arn is False:
+            self.arn = config.client("dynamodb").describe_table(TableName=self.table)["Table"].get("LatestStreamArn")
+            if not self.arn:
+                print(f"[FEED] {self.table} has no stream enabled; job events unavailable")
+        return self.arn
+
+    def start(self):
+        """Start the reader thread unless it is running."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="job-change-feed", daemon=True)
+                self.thread.start()
+
+    def live(self) -> bool:
+        """Whether this process is reading the stream right now, i.e. subscribers will hear about changes."""
+        self.start()
+        return self.reading
+
+    # ---------------- SUBSCRIBERS ----------------
+    def add_listener(self, callback):
+        """Call callback(event) for every event, in this process, and start reading."""
+        self.listeners.append(callback)
+        self.start()
+
+    def subscribe(self, owner=None) -> asyncio.Queue:
+        """Queue of events for one client; check live() first."""
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+        with self.lock:
+            self.subscribers[queue] = (asyncio.get_running_loop(), owner)
+        self.start()
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.pop(queue, None)
+
+    def publish(self, event):
+        for callback in self.listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[FEED] Listener failed: {e}")
+        with self.lock:
+            self.seq += 1
+            event["seq"] = self.seq
+            targets = [(q, loop) for q, (loop, owner) in self.subscribers.items()
+                       if owner is None or owner == event["owner"]]
+        for queue, loop in targets:
+            loop.call_soon_threadsafe(_deliver, queue, event)
+
+    # ---------------- STREAM READER ----------------
+    def _run(self):
+        streams = config.client("dynamodbstreams")
+        backoff = 1
+        while True:
+            try:
+                stream_arn = self.stream_arn()
+                if not stream_arn:
+                    return  # no stream on the table, nothing will ever arrive
+                if self._hold_slot():
+                    backoff = 1
+                    self._read(streams, stream_arn)
+                else:
+                    time.sleep(LEASE_SECONDS)
+            except Exception as e:
+                print(f"[FEED] Stream reader failed, retrying in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, RETRY_MAX_SECONDS)
+            finally:
+                self.reading = False
+
+    def _hold_slot(self):
+        """Take or renew a reader slot lease; False if all slots are held by live processes."""
+        now = int(time.time())
+        slots = [self.slot] if self.reading else range(MAX_STREAM_READERS)
+        for slot in slots:
+            try:
+                config.client("dynamodb").put_item(
+                    TableName=LEASE_TABLE,
+                    Item={
+                        "lease": {"S": f"{self.table}#stream-reader#{slot}"},
+                        "owner": {"S": self.reader_id},
+                        "expires": {"N": str(now + LEASE_SECONDS)},
+                    },
+                    ConditionExpression="attribute_not_exists(lease) OR expires < :now OR #o = :me",
+                    ExpressionAttributeNames={"#o": "owner"},
+                    ExpressionAttributeValues={":now": {"N": str(now)}, ":me": {"S": self.reader_id}},
+                )
+                self.slot = slot
+                return True
+            except config.client("dynamodb").exceptions.ConditionalCheckFailedException:
+                continue
+        return False
+
+    def _read(self, streams, stream_arn):
+        """Tail every shard while we keep our slot; returns when the lease is lost."""
+        self.reading = True
+        renewed = time.monotonic()
+        # Events may have been missed while we weren't reading
+        self._resync()
+
+        iterators = {}   # shard id -> next iterator
+        known = set()
+        refreshed = 0.0
+        first = True
+        while True:
+            if time.monotonic() - renewed > LEASE_SECONDS / 3:
+                if not self._hold_slot():
+                    print("[FEED] Lost the stream reader slot")
+                    return
+                renewed = time.monotonic()
+            try:
+                if time.monotonic() - refreshed > SHARD_REFRESH_SECONDS:
+                    for shard in _list_shards(streams, stream_arn):
+                        shard_id = shard["ShardId"]
+                        if shard_id in known:
+                            continue
+                        known.add(shard_id)
+                        closed = "EndingSequenceNumber" in shard["SequenceNumberRange"]
+                        if first and closed:
+                            continue
+                        # Existing shards from now on; shards split later from the start
+                        iterators[shard_id] = streams.get_shard_iterator(
+                            StreamArn=stream_arn, ShardId=shard_id,
+                            ShardIteratorType="LATEST" if first else "TRIM_HORIZON",
+                        )["ShardIterator"]
+                    refreshed = time.monotonic()
+                    first = False
+
+                for shard_id, iterator in list(iterators.items()):
+                    try:
+                        resp = streams.get_records(ShardIterator=iterator, Limit=1000)
+                    except streams.exceptions.ExpiredIteratorException:
+                        iterators[shard_id] = streams.get_shard_iterator(
+                            StreamArn=stream_arn, ShardId=shard_id, ShardIteratorType="LATEST",
+                        )["ShardIterator"]
+                        continue
+                    for record in resp.get("Records", []):
+                        event = self._event(record)
+                        if event:
+                            self.publish(event)
+                    if resp.get("NextShardIterator"):
+                        iterators[shard_id] = resp["NextShardIterator"]
+                    else:
+                        # Shard closed; its children turn up on the next refresh
+                        del iterators[shard_id]
+                        refreshed = 0.0
+            except Exception as e:
+                print(f"[FEED] Stream read failed: {e}")
+                time.sleep(5)
+            time.sleep(self.poll_interval)
+
+    def _resync(self):
+        # Subscribers refetch; listeners' caches catch up by their own TTL
+        with self.lock:
+            self.seq += 1
+            targets = [(q, loop) for q, (loop, _) in self.subscribers.items()]
+        for queue, loop in targets:
+            loop.call_soon_threadsafe(_deliver, queue, {"type": "resync", "seq": self.seq})
+
+    def _event(self, record):
+        data = record["dynamodb"]
+        new = _plain(data.get("NewImage", {}))
+        old = _plain(data.get("OldImage", {}))
+        job = new or old
+        if "jobs_id" not in job:
+            return None
+
+        if record["eventName"] == "INSERT":
+            kind = "created"
+        elif record["eventName"] == "REMOVE":
+            kind = "deleted"
+        elif new.get("status") != old.get("status"):
+            kind = "status"
+        elif new.get("progress") != old.get("progress"):
+            kind = "progress"
+        else:
+            return None
+
+        event = {
+            "type": kind,
+            "jobs_id": job["jobs_id"],
+            "owner": job.get("qut-username"),
+            "job": {k: job[k] for k in self.attributes if k in job},
+        }
+        if kind == "progress":
+            event["progress"] = new.get("progress")
+        return event
+
+
+def _deliver(queue, event):
+    # Runs on the subscriber's event loop
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({"type": "resync", "seq": event["seq"]})
+
+
+def _list_shards(streams, stream_arn):
+    kwargs = {}
+    while True:
+        desc = streams.describe_stream(StreamArn=stream_arn, **kwargs)["StreamDescription"]
+        yield from desc.get("Shards", [])
+        if not desc.get("LastEvaluatedShardId"):
+            return
+        kwargs["ExclusiveStartShardId"] = desc["LastEvaluatedShardId"]
+
+
+def _plain(image):
+    return {k: TypeDeserializer().deserialize(v) for k, v in image.items()}
@@ -0,0 +1,122 @@
+import os, json, threading
+import boto3
+import requests
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------------- SETTINGS ----------------
+DEFAULT_REGION = "ap-southeast-2"
+PARAMETERS = {
+    "region": "/n10893997/aws_region",
+    "user_pool_id": "/n10893997/cognito_user_pool_id",
+    "client_id": "/n10893997/cognito_client_id",
+}
+CLIENT_SECRET_ID = "/n10893997/cognito_client_secret"
+# Last good config; lets a fresh container serve before AWS answers
+CONFIG_SNAPSHOT = os.getenv("CONFIG_SNAPSHOT", "/tmp/n10893997-config.json")
+FETCH_TIMEOUT = 5
+# HTTP connections per client; also the size of the API's AWS I/O thread pool
+MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+
+session = boto3.session.Session(region_name=DEFAULT_REGION)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# ---------------- SHARED CLIENTS ----------------
+def client(service: str, region: str = None):
+    """boto3 client for service from the shared session, created on first use.
+
+    region overrides the session's DEFAULT_REGION, e.g. with the configured one.
+    """
+    region = region or DEFAULT_REGION
+    with _clients_lock:
+        if (service, region) not in _clients:
+            _clients[service, region] = session.client(
+                service, region_name=region, config=Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            )
+        return _clients[service, region]
+
+
+class LazyClient:
+    """Stands in for a boto3 client at import time; builds the real one on first attribute access."""
+
+    def __init__(self, service, region=None):
+        self._service = service
+        self._region = region
+
+    def __getattr__(self, name):
+        return getattr(client(self._service, self._region), name)
+
+
+# ---------------- BOOTSTRAP ----------------
+def _fetch() -> dict:
+    """Fetch parameters, the client secret and the JWKS; independent calls run concurrently."""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        params = pool.submit(client("ssm").get_parameters, Names=list(PARAMETERS.values()))
+        secret = pool.submit(client("secretsmanager").get_secret_value, SecretId=CLIENT_SECRET_ID)
+
+        try:
+            values = {p["Name"]: p["Value"] for p in params.result()["Parameters"]}
+        except Exception as e:
+            print(f"[CONFIG] Failed to load parameters: {e}")
+            values = {}
+        settings = {key: values.get(name) for key, name in PARAMETERS.items()}
+        for key, name in PARAMETERS.items():
+            print(f"[CONFIG] {'Loaded' if settings[key] else 'Missing'} {name}")
+
+        # The key set URL needs the pool id, so it waits for the parameters
+        jwks_url = f"https://cognito-idp.{settings['region']}.amazonaws.com/{settings['user_pool_id']}/.well-known/jwks.json"
+        jwks = pool.submit(requests.get, jwks_url, timeout=FETCH_TIMEOUT)
+
+        try:
+            settings["client_secret"] = secret.result()["SecretString"]
+        except Exception as e:
+            print(f"[CONFIG] Failed to load secret: {e}")
+            settings["client_secret"] = os.getenv("COGNITO_CLIENT_SECRET")
+        try:
+            settings["jwks"] = jwks.result().json()
+        except Exception as e:
+            print(f"[CONFIG] Failed to fetch JWKS: {e}")
+            settings["jwks"] = None
+    return settings
+
+
+def _save(settings: dict):
+    # Holds the client secret: owner-only permissions, atomic replace
+    tmp = f"{CONFIG_SNAPSHOT}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(settings, f)
+    os.replace(tmp, CONFIG_SNAPSHOT)
+
+
+def bootstrap(on_refresh=None) -> dict:
+    """App config: from the on-disk snapshot if there is one (refreshed in the background), else fetched now.
+
+    on_refresh(settings) is called after a background refresh replaces snapshot values.
+    """
+    try:
+        with open(CONFIG_SNAPSHOT) as f:
+            settings = json.load(f)
+        print(f"[CONFIG] Using snapshot {CONFIG_SNAPSHOT}, refreshing in background")
+    except (OSError, ValueError):
+        settings = _fetch()
+        if settings.get("region") and settings.get("user_pool_id") and settings.get("client_id"):
+            _save(settings)
+        return settings
+
+    def refresh():
+        try:
+            fresh = _fetch()
+        except Exception as e:
+            print(f"[CONFIG] Background refresh failed, keeping snapshot: {e}")
+            return
+        # Keep snapshot values for anything this fetch couldn't get
+        settings.update({k: v for k, v in fresh.items() if v})
+        _save(settings)
+        if on_refresh:
+            on_refresh(settings)
+
+    threading.Thread(target=refresh, name="config-refresh", daemon=True).start()
+    return settings
@@ -1,126 +1,444 @@
-import os, uuid, boto3
-from fastapi import APIRouter, Depends, HTTPException
-from datetime import datetime
-from typing import Optional
-from auth import get_current_user
+import uuid, posixpath, asyncio
+from fastapi import APIRouter, Depends, HTTPException, Request
+from typing import Optional, List
+from pydantic import BaseModel
+from cachetools import TTLCache
+from repository import AsyncClient, Table, run, gather_limited
+from auth import get_current_user, is_admin
+from jobs import find_job, job_owner
+from response_cache import response_cache
+from probe import probe_media, ProbeError, ProbeUnavailable
+from jobrecords import OUTPUT_FORMATS, upload_key, owns_upload, upload_metadata, upload_item, job_item, job_id_for
 
 router = APIRouter(tags=["files"])
 
 # ---------------- AWS CONFIG ----------------
-REGION = "ap-southeast-2"
 S3_BUCKET = "n10893997-videos"
 UPLOADS_TABLE = "n10893997-a2"
 JOBS_TABLE = "n10893997-a2-jobs3"
 
-s3_client = boto3.client("s3", region_name=REGION)
-dynamodb = boto3.client("dynamodb", region_name=REGION)
+HLS_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+
+# Presigned GET URLs live an hour; a cached one is handed out again until it has less than the margin left
+PRESIGN_EXPIRY = 3600
+PRESIGN_REUSE_MARGIN = 300
+PRESIGN_CACHE_SIZE = 10000
+MAX_BATCH_IDS = 100
+# A signed HLS ladder must outlast playback, not just the first request: its URLs get the
+# reuse window plus the media duration plus a margin for pauses and seeking, so a copy handed
+# out at the end of its cache life still plays through. SigV4 caps presigned URLs at 7 days
+# (and role credentials expire sooner, whatever ExpiresIn says)
+HLS_PLAYBACK_MARGIN = 3600
+HLS_DEFAULT_DURATION = 4 * 3600  # jobs without probe data
+PRESIGN_MAX_EXPIRY = 7 * 24 * 3600
+_presigned = TTLCache(maxsize=PRESIGN_CACHE_SIZE, ttl=PRESIGN_EXPIRY - PRESIGN_REUSE_MARGIN)
+_signed_playlists = TTLCache(maxsize=PRESIGN_CACHE_SIZE, ttl=PRESIGN_EXPIRY - PRESIGN_REUSE_MARGIN)
+
+s3_client = AsyncClient("s3")
+uploads_table = Table(UPLOADS_TABLE, ("qut-username", "file_id"))
+jobs_table = Table(JOBS_TABLE, ("qut-username", "jobs_id"))
+
+def _check_format(output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"output_format must be one of {', '.join(OUTPUT_FORMATS)}")
 
 # ---------------- Presigned Upload ----------------
 @router.post("/upload-url")
-def get_upload_url(filename: str, user=Depends(get_current_user)):
-    """Generate a presigned S3 URL for direct upload"""
+async def get_upload_url(filename: str, imdbID: Optional[str] = "", output_format: Optional[str] = "mp4", user=Depends(get_current_user)):
+    """Generate a presigned S3 URL for direct upload.
+
+    The PUT must send the returned headers; they carry the job details, and
+    the worker creates and queues the job when S3 reports the new object.
+    """
+    _check_format(output_format)
     try:
         file_id = str(uuid.uuid4())
-        s3_key = f"{user['cognito:username']}/{file_id}_{filename}"
+        s3_key = upload_key(user["cognito:username"], file_id, filename)
+        metadata = upload_metadata(filename, imdbID, output_format)
 
         url = s3_client.generate_presigned_url(
             "put_object",
-            Params={"Bucket": S3_BUCKET, "Key": s3_key},
+            Params={"Bucket": S3_BUCKET, "Key": s3_key, "Metadata": metadata},
             ExpiresIn=3600,
         )
 
-        return {"upload_url": url, "s3_key": s3_key, "file_id": file_id, "filename": filename}
+        return {
+            "upload_url": url,
+            "headers": {f"x-amz-meta-{k}": v for k, v in metadata.items()},
+            "s3_key": s3_key,
+            "file_id": file_id,
+            "filename": filename,
+            "job_id": job_id_for(file_id),
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/confirm-upload")
-def confirm_upload(file_id: str, s3_key: str, filename: str, imdbID: Optional[str] = "", user=Depends(get_current_user)):
-    """Confirm upload, save metadata to DynamoDB, and queue a job"""
+# ---------------- Multipart Upload ----------------
+# Parts of 16 MiB (S3 needs >= 5 MiB except the last, and at most 10,000 parts)
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+MAX_PART_URLS = 100
+# Abandoned uploads are aborted by the bucket's lifecycle rule (see iac-template.yaml)
+# 7 days after initiation; until then they can be resumed
+
+class PartUrlsRequest(BaseModel):
+    s3_key: str
+    part_numbers: List[int]
+
+class CompletedPart(BaseModel):
+    part_number: int
+    etag: str
+
+class CompleteUploadRequest(BaseModel):
+    s3_key: str
+    parts: Optional[List[CompletedPart]] = None  # omitted: use what S3 has
+
+
+def _own_key(user: dict, s3_key: str):
+    if not owns_upload(user["cognito:username"], s3_key):
+        raise HTTPException(status_code=403, detail="You can only access your own uploads")
+
+
+async def _uploaded_parts(upload_id: str, s3_key: str) -> list:
+    parts, kwargs = [], {}
+    while True:
+        resp = await s3_client.list_parts(Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id, **kwargs)
+        parts += [{"part_number": p["PartNumber"], "etag": p["ETag"], "size": p["Size"]} for p in resp.get("Parts", [])]
+        if not resp.get("IsTruncated"):
+            return parts
+        kwargs["PartNumberMarker"] = resp["NextPartNumberMarker"]
+
+
+@router.post("/uploads/multipart")
+async def initiate_multipart_upload(filename: str, size: int, imdbID: Optional[str] = "", output_format: Optional[str] = "mp4", user=Depends(get_current_user)):
+    """Start a multipart upload; the client then uploads parts in parallel through presigned part URLs.
+
+    The job details go on the object, so completing the upload is enough to queue the transcode.
+    """
+    _check_format(output_format)
     try:
-        username = user["cognito:username"]
-
-        # Save upload metadata
-        dynamodb.put_item(
-            TableName=UPLOADS_TABLE,
-            Item={
-                "qut-username": {"S": username},
-                "file_id": {"S": file_id},
-                "filename": {"S": filename},
-                "uploaded": {"S": datetime.utcnow().isoformat()},
-                "imdbID": {"S": imdbID or ""},
-                "s3_key": {"S": s3_key},
-            },
+        part_size = max(MULTIPART_PART_SIZE, -(-size // MULTIPART_MAX_PARTS))
+        file_id = str(uuid.uuid4())
+        s3_key = upload_key(user["cognito:username"], file_id, filename)
+        resp = await s3_client.create_multipart_upload(
+            Bucket=S3_BUCKET, Key=s3_key, Metadata=upload_metadata(filename, imdbID, output_format),
         )
+        return {
+            "upload_id": resp["UploadId"],
+            "s3_key": s3_key,
+            "file_id": file_id,
+            "job_id": job_id_for(file_id),
+            "filename": filename,
+            "part_size": part_size,
+            "part_count": max(1, -(-size // part_size)),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Create a queued job
-        job_id = str(uuid.uuid4())
-        dynamodb.put_item(
-            TableName=JOBS_TABLE,
-            Item={
-                "qut-username": {"S": username},
-                "jobs_id": {"S": job_id},
-                "file_id": {"S": file_id},
-                "filename": {"S": filename},
-                "s3_key": {"S": s3_key},
-                "status": {"S": "queued"},
-                "created": {"S": datetime.utcnow().isoformat()},
-            },
-        )
 
-        return {"message": "File metadata saved and job queued", "file_id": file_id, "job_id": job_id}
+@router.post("/uploads/multipart/{upload_id}/parts")
+async def presign_upload_parts(upload_id: str, req: PartUrlsRequest, user=Depends(get_current_user)):
+    """Presigned PUT URLs for a batch of part numbers"""
+    _own_key(user, req.s3_key)
+    if len(req.part_numbers) > MAX_PART_URLS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PART_URLS} parts per request")
+    if any(n < 1 or n > MULTIPART_MAX_PARTS for n in req.part_numbers):
+        raise HTTPException(status_code=400, detail=f"Part numbers must be 1-{MULTIPART_MAX_PARTS}")
+    try:
+        urls = {
+            n: s3_client.generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": S3_BUCKET, "Key": req.s3_key, "UploadId": upload_id, "PartNumber": n},
+                ExpiresIn=3600,
+            )
+            for n in req.part_numbers
+        }
+        return {"urls": urls}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# ---------------- Presigned Download ----------------
-@router.get("/download-url/{file_id}")
-def get_download_url(file_id: str, user=Depends(get_current_user)):
-    """Generate a presigned S3 URL for original file download"""
+@router.get("/uploads/multipart/{upload_id}/parts")
+async def list_upload_parts(upload_id: str, s3_key: str, user=Depends(get_current_user)):
+    """Parts S3 already has, so an interrupted upload can resume where it stopped"""
+    _own_key(user, s3_key)
     try:
-        resp = dynamodb.get_item(
-            TableName=UPLOADS_TABLE,
-            Key={"qut-username": {"S": user["cognito:username"]}, "file_id": {"S": file_id}},
+        return {"parts": await _uploaded_parts(upload_id, s3_key)}
+    except s3_client.exceptions.NoSuchUpload:
+        raise HTTPException(status_code=404, detail="Upload not found (completed or aborted)")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/uploads/multipart/{upload_id}/complete")
+async def complete_multipart_upload(upload_id: str, req: CompleteUploadRequest, user=Depends(get_current_user)):
+    """Assemble the parts; S3 then notifies the worker, which creates and queues the job"""
+    _own_key(user, req.s3_key)
+    try:
+        if req.parts is None:
+            parts = await _uploaded_parts(upload_id, req.s3_key)
+        else:
+            parts = [p.model_dump() for p in req.parts]
+        if not parts:
+            raise HTTPException(status_code=400, detail="No parts uploaded")
+        await s3_client.complete_multipart_upload(
+            Bucket=S3_BUCKET,
+            Key=req.s3_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": p["part_number"], "ETag": p["etag"]}
+                                       for p in sorted(parts, key=lambda p: p["part_number"])]},
         )
-        if "Item" not in resp:
-            raise HTTPException(status_code=404, detail="File not found")
+        return {"message": "Upload complete", "s3_key": req.s3_key}
+    except HTTPException:
+        raise
+    except s3_client.exceptions.NoSuchUpload:
+        raise HTTPException(status_code=404, detail="Upload not found (completed or aborted)")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        s3_key = resp["Item"]["s3_key"]["S"]
 
-        url = s3_client.generate_presigned_url(
+@router.delete("/uploads/multipart/{upload_id}")
+async def abort_multipart_upload(upload_id: str, s3_key: str, user=Depends(get_current_user)):
+    """Abort an upload and drop the parts already stored"""
+    _own_key(user, s3_key)
+    try:
+        await s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=s3_key, UploadId=upload_id)
+        return {"message": "Upload aborted"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/confirm-upload")
+async def confirm_upload(file_id: str, s3_key: str, filename: str, imdbID: Optional[str] = "", output_format: Optional[str] = "mp4", user=Depends(get_current_user)):
+    """Confirm upload, save metadata to DynamoDB, and queue a job.
+
+    Optional since uploads are ingested from S3 events; both paths write the
+    same rows under the same job id, so whichever runs second changes nothing.
+    """
+    _check_format(output_format)
+    username = user["cognito:username"]
+    if not owns_upload(username, s3_key):
+        raise HTTPException(status_code=403, detail="You can only confirm your own uploads")
+
+    job_id = job_id_for(file_id)
+    try:
+        existing = await jobs_table.get(username, job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if existing:
+        return {"message": "Upload already ingested", "file_id": file_id, "job_id": job_id}
+
+    # Probe the container header through ranged reads; unplayable files never reach the queue
+    try:
+        source_url = s3_client.generate_presigned_url(
             "get_object",
             Params={"Bucket": S3_BUCKET, "Key": s3_key},
-            ExpiresIn=3600,
+            ExpiresIn=300,
         )
-        return {"download_url": url}
+        media = await run(probe_media, source_url)
+    except ProbeError as e:
+        # Only a file ffprobe read and found unusable is deleted
+        await s3_client.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+        raise HTTPException(status_code=422, detail=f"Unplayable video rejected: {e}")
+    except ProbeUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"Could not read the upload, try again: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    try:
+        created = True
+        for table, item, key_name in (
+            (uploads_table, upload_item(username, file_id, filename, s3_key, imdbID, media), "file_id"),
+            (jobs_table, job_item(username, file_id, filename, s3_key, output_format, media), "jobs_id"),
+        ):
+            try:
+                await table.put(item, ConditionExpression=f"attribute_not_exists({key_name})")
+            except uploads_table.dynamodb.exceptions.ConditionalCheckFailedException:
+                created = False
+
+        response_cache.invalidate(username)
+        message = "File metadata saved and job queued" if created else "Upload already ingested"
+        return {"message": message, "file_id": file_id, "job_id": job_id, "media": media}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ---------------- Presigned Download ----------------
+@router.get("/download-url/{file_id}")
+async def get_download_url(file_id: str, request: Request, user=Depends(get_current_user)):
+    """Generate a presigned S3 URL for original file download"""
+    try:
+        async def build():
+            item = await uploads_table.get(user["cognito:username"], file_id)
+            if not item:
+                raise HTTPException(status_code=404, detail="File not found")
+
+            return {"download_url": _presign_get(item["s3_key"]["S"])}
+
+        # URL has at least PRESIGN_REUSE_MARGIN left, far longer than the cache TTL
+        return await response_cache.respond(request, user["cognito:username"], build)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _presign(key: str, expires: int = PRESIGN_EXPIRY) -> str:
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": S3_BUCKET, "Key": key},
+        ExpiresIn=expires,
+    )
+
+def _presign_get(key: str) -> str:
+    """Presigned GET URL for key, reusing a cached one while it is still valid long enough"""
+    url = _presigned.get(key)
+    if url is None:
+        url = _presigned[key] = _presign(key)
+    return url
+
+def _rewrite_playlist(text: str, base_dir: str, rewrite) -> str:
+    # Every non-comment line of an m3u8 is a URI relative to the playlist
+    lines = []
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            line = rewrite(posixpath.normpath(posixpath.join(base_dir, line)))
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def _media_duration(item: dict) -> float:
+    try:
+        return float(item["duration"]["N"])
+    except (KeyError, ValueError):
+        return HLS_DEFAULT_DURATION
+
+async def _signed_hls_playlist(master_key: str, duration: float) -> str:
+    """Presigned URL for a copy of the HLS master playlist whose variant playlists
+    and segments are presigned too, so any HLS player can fetch the whole ladder"""
+    cached = _signed_playlists.get(master_key)
+    if cached:
+        return cached
+    base = posixpath.dirname(master_key)
+    expires = min(PRESIGN_EXPIRY + int(duration) + HLS_PLAYBACK_MARGIN, PRESIGN_MAX_EXPIRY)
+    sign = lambda key: _presign(key, expires)
+
+    async def read(key):
+        resp = await s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        return (await run(resp["Body"].read)).decode("utf-8")
+
+    async def put(key, text):
+        await s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=text.encode("utf-8"), ContentType=HLS_CONTENT_TYPE)
+
+    master = await read(master_key)
+    # Variants are independent, so sign them concurrently
+    variant_keys = []
+    _rewrite_playlist(master, base, lambda key: variant_keys.append(key) or key)
+
+    async def sign_variant(variant_key):
+        signed_key = f"{base}/signed/{posixpath.relpath(variant_key, base)}"
+        # Fresh URLs throughout, valid for the whole of playback after the cache entry expires
+        await put(signed_key, _rewrite_playlist(await read(variant_key), posixpath.dirname(variant_key), sign))
+        return variant_key, sign(signed_key)
+
+    signed = dict(await asyncio.gather(*(sign_variant(k) for k in variant_keys)))
+    signed_master = f"{base}/signed/master.m3u8"
+    await put(signed_master, _rewrite_playlist(master, base, signed.__getitem__))
+    url = _signed_playlists[master_key] = sign(signed_master)
+    return url
+
 
 @router.get("/download/{jobs_id}")
-def download_file(jobs_id: str, user=Depends(get_current_user)):
+async def download_file(jobs_id: str, user=Depends(get_current_user)):
     """Generate a presigned S3 URL for transcoded file download"""
     try:
-        resp = dynamodb.get_item(
-            TableName=JOBS_TABLE,
-            Key={"qut-username": {"S": user["cognito:username"]}, "jobs_id": {"S": jobs_id}},
-        )
-        if "Item" not in resp:
+        # Admins can download any job's output
+        item = await find_job(jobs_id, user)
+        if not item:
             raise HTTPException(status_code=404, detail="Job not found")
 
-        item = resp["Item"]
         if item.get("status", {}).get("S") != "completed":
             raise HTTPException(status_code=400, detail="File not ready for download")
 
         s3_key = item["output"]["S"]
 
-        url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": S3_BUCKET, "Key": s3_key},
-            ExpiresIn=3600,
-        )
+        # Adaptive bitrate jobs hand back the HLS master playlist
+        if s3_key.endswith(".m3u8"):
+            url = await _signed_hls_playlist(s3_key, _media_duration(item))
+            return {"download_url": url, "playlist_url": url, "format": "hls"}
+
+        url = _presign_get(s3_key)
         print("[DEBUG] Pre-signed URL generated:", url)
 
         return {"download_url": url}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ---------------- Batch Presigned Download ----------------
+class DownloadUrlsRequest(BaseModel):
+    job_ids: List[str] = []
+    file_ids: List[str] = []
+
+
+@router.post("/download-urls")
+async def get_download_urls(req: DownloadUrlsRequest, user=Depends(get_current_user)):
+    """Presigned URLs for many transcoded jobs and/or original uploads in one call.
+
+    Items are read with BatchGetItem; ids that are missing or not ready come
+    back under "errors" instead of failing the whole request.
+    """
+    if len(req.job_ids) + len(req.file_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    username = user["cognito:username"]
+    try:
+        # Admins may ask for anyone's jobs: resolve owners through the jobs_id index
+        if is_admin(user):
+            owners = await gather_limited([job_owner(j) for j in req.job_ids], MAX_BATCH_IDS)
+            job_keys = [(o, j) for o, j in zip(owners, req.job_ids) if isinstance(o, str)]
+        else:
+            job_keys = [(username, j) for j in req.job_ids]
+
+        jobs, uploads = await asyncio.gather(
+            jobs_table.batch_get(job_keys, ProjectionExpression="jobs_id, #s, #o, #d",
+                                 ExpressionAttributeNames={"#s": "status", "#o": "output", "#d": "duration"}),
+            uploads_table.batch_get([(username, f) for f in req.file_ids], ProjectionExpression="file_id, s3_key"),
+        )
+
+        urls, errors = {"jobs": {}, "files": {}}, {"jobs": {}, "files": {}}
+        found_jobs = {item["jobs_id"]["S"]: item for item in jobs}
+        ready = {}
+        for jobs_id in req.job_ids:
+            item = found_jobs.get(jobs_id)
+            if not item:
+                errors["jobs"][jobs_id] = "Job not found"
+            elif item.get("status", {}).get("S") != "completed" or "output" not in item:
+                errors["jobs"][jobs_id] = "File not ready for download"
+            else:
+                ready[jobs_id] = item
+
+        # HLS outputs need their playlists signed; do those concurrently
+        hls = [(j, item) for j, item in ready.items() if item["output"]["S"].endswith(".m3u8")]
+        playlists = dict(zip((j for j, _ in hls), await asyncio.gather(
+            *(_signed_hls_playlist(item["output"]["S"], _media_duration(item)) for _, item in hls))))
+        for jobs_id, item in ready.items():
+            if jobs_id in playlists:
+                url = playlists[jobs_id]
+                urls["jobs"][jobs_id] = {"download_url": url, "playlist_url": url, "format": "hls"}
+            else:
+                urls["jobs"][jobs_id] = {"download_url": _presign_get(item["output"]["S"])}
+
+        found_files = {item["file_id"]["S"]: item["s3_key"]["S"] for item in uploads}
+        for file_id in req.file_ids:
+            if file_id in found_files:
+                urls["files"][file_id] = {"download_url": _presign_get(found_files[file_id])}
+            else:
+                errors["files"][file_id] = "File not found"
+
+        return {"urls": urls, "errors": errors}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,6 +1,10 @@
 import streamlit as st
 import requests
-import os
+import json, time, threading, base64
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_autorefresh import st_autorefresh
 
 # BASE_URL = "http://n10893997.cab432.com:3000"
@@ -16,6 +20,13 @@ if "selected_metadata" not in st.session_state: st.session_state["selected_metad
 if "show_metadata_modal" not in st.session_state: st.session_state["show_metadata_modal"] = False
 if "pending_challenge" not in st.session_state: st.session_state["pending_challenge"] = None
 if "current_page" not in st.session_state: st.session_state["current_page"] = 1
+if "page_cursors" not in st.session_state: st.session_state["page_cursors"] = [None]   # cursor for each visited page
+if "list_filters" not in st.session_state: st.session_state["list_filters"] = None
+if "active_jobs" not in st.session_state: st.session_state["active_jobs"] = None   # cached Job Queue rows
+if "page_jobs" not in st.session_state: st.session_state["page_jobs"] = None       # cached All Jobs page
+if "job_listener" not in st.session_state: st.session_state["job_listener"] = None
+if "last_poll" not in st.session_state: st.session_state["last_poll"] = 0.0           # fallback polling when there is no event stream
+if "multipart_uploads" not in st.session_state: st.session_state["multipart_uploads"] = {}  # "name:size:imdb:format" -> unfinished upload
 if "mfa_qr" not in st.session_state: st.session_state["mfa_qr"] = None      # MFA QR persistence
 
 # ---------------- AUTH ----------------
@@ -115,8 +126,11 @@ else:
     st.success(f"Logged in as {st.session_state['username']}")
 
     if st.button("Logout"):
+        if st.session_state["job_listener"]:
+            st.session_state["job_listener"].stop()
         for key in ["token","access_token","username","search_results",
-                    "selected_metadata","show_metadata_modal","pending_challenge","mfa_qr"]:
+                    "selected_metadata","show_metadata_modal","pending_challenge","mfa_qr",
+                    "job_listener","active_jobs","page_jobs"]:
             st.session_state[key] = None
         st.session_state["current_page"] = 1
         st.rerun()
@@ -151,48 +165,240 @@ else:
 token = st.session_state.get("token", None)
 headers = {"Authorization": f"Bearer {token}"} if token else {}
 
+# ---------------- JOB EVENTS ----------------
+# Without an event stream, job lists are refetched at most this often
+POLL_INTERVAL = 5
+# Reruns (every 2s while the tab is open) mark the listener as wanted; once they
+# stop - tab closed or session gone - the listener hangs up within one keep-alive
+LISTENER_IDLE_SECONDS = 90
+
+
+def _token_expiry(token):
+    """The JWT's exp claim (epoch seconds), read without verifying; the API does the verifying."""
+    try:
+        payload = token.split(".")[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return float("inf")
+
+
+class JobEventListener:
+    """Reads the API's /jobs/events stream on a background thread; the page drains .events on each rerun.
+
+    The thread ends on stop(), when the token expires or is rejected, or when
+    the page hasn't called touch() for LISTENER_IDLE_SECONDS.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.expires = _token_expiry(token)
+        self.events = deque()
+        self.running = True
+        self.available = True   # False once the API says it has no event stream
+        self.idle = False       # True if it hung up because the page stopped rerunning
+        self.last_seen = time.monotonic()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def _wanted(self):
+        if self.running and time.monotonic() - self.last_seen > LISTENER_IDLE_SECONDS:
+            self.idle = True
+            self.running = False
+        if time.time() >= self.expires:
+            self.running = False
+        return self.running
+
+    def _run(self):
+        while self._wanted():
+            try:
+                with requests.get(f"{BASE_URL}/jobs/events", headers={"Authorization": f"Bearer {self.token}"},
+                                  stream=True, timeout=(5, 60)) as res:
+                    if res.status_code == 401:
+                        self.running = False
+                        return
+                    if res.status_code != 200:
+                        self.available = False
+                        self.running = False
+                        return
+                    # Anything may have changed while we weren't connected
+                    self.events.append({"type": "resync"})
+                    data = []
+                    # Keep-alive pings arrive every 15s, so this is checked at least that often
+                    for line in res.iter_lines(decode_unicode=True):
+                        if not self._wanted():
+                            return
+                        if line.startswith("data:"):
+                            data.append(line[5:].strip())
+                        elif not line and data:
+                            self.events.append(json.loads("\n".join(data)))
+                            data = []
+            except (requests.RequestException, ValueError):
+                pass
+            time.sleep(3)
+
+
+def refresh_jobs():
+    """Drop cached job lists so the next render refetches them."""
+    st.session_state["active_jobs"] = None
+    st.session_state["page_jobs"] = None
+
+
+def apply_job_events():
+    """Patch the cached job lists with pushed changes; refetch only when rows appear or disappear."""
+    listener = st.session_state["job_listener"]
+    expired = time.time() >= _token_expiry(token)
+    # A listener that hung up while the tab was idle is replaced; its resync refetches
+    if listener is None or listener.token != token or (listener.idle and not expired):
+        if listener:
+            listener.stop()
+        listener = st.session_state["job_listener"] = None if expired else JobEventListener(token)
+    if listener is None or not listener.running:
+        # No event stream (or the token was rejected): poll at the old interval rather than on every 2s rerun
+        if time.monotonic() - st.session_state["last_poll"] >= POLL_INTERVAL:
+            st.session_state["last_poll"] = time.monotonic()
+            refresh_jobs()
+        return
+    listener.touch()
+
+    while listener.events:
+        event = listener.events.popleft()
+        if event["type"] in ("resync", "created", "deleted"):
+            refresh_jobs()
+        elif event["type"] == "status":
+            changed = event["job"]
+            if st.session_state["active_jobs"] is not None:
+                active = [j for j in st.session_state["active_jobs"] if j.get("jobs_id") != event["jobs_id"]]
+                if changed.get("status") != "completed":
+                    active.append(changed)
+                st.session_state["active_jobs"] = active
+            if st.session_state["page_jobs"] is not None:
+                for job in st.session_state["page_jobs"]["jobs"]:
+                    if job.get("jobs_id") == event["jobs_id"]:
+                        job.update(changed)
+
+
+# ---------------- DOWNLOAD LINKS ----------------
+# Presigned links are fetched again this long before they expire
+URL_REFRESH_MARGIN = 60
+
+def presigned_expiry(url):
+    """Epoch seconds when a SigV4 presigned URL stops working (X-Amz-Date + X-Amz-Expires)."""
+    try:
+        query = parse_qs(urlparse(url).query)
+        signed = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return signed.timestamp() + int(query["X-Amz-Expires"][0])
+    except (KeyError, IndexError, ValueError):
+        return time.time() + 300  # unknown format: assume it is short-lived
+
+
+# ---------------- MULTIPART UPLOAD ----------------
+UPLOAD_PARALLELISM = 4
+PART_RETRIES = 3
+
+def multipart_upload(uploaded_file, progress, imdb_id="", output_format="mp4"):
+    """Upload in parallel presigned parts, one part in memory per worker.
+
+    The job details travel with the upload; once it completes the backend
+    queues the transcode on its own. A previous attempt at the same file
+    resumes from the parts S3 already has.
+    Returns (s3_key, job_id); raises RuntimeError on failure.
+    """
+    size = uploaded_file.size
+    resume_key = f"{uploaded_file.name}:{size}:{imdb_id}:{output_format}"
+    uploads = st.session_state["multipart_uploads"]
+    state = uploads.get(resume_key)
+    done = {}
+    if state:
+        res = requests.get(f"{BASE_URL}/uploads/multipart/{state['upload_id']}/parts",
+                           params={"s3_key": state["s3_key"]}, headers=headers)
+        if res.status_code == 200:
+            done = {p["part_number"]: p["etag"] for p in res.json()["parts"]}
+        else:
+            state = None
+    if not state:
+        res = requests.post(f"{BASE_URL}/uploads/multipart", params={"filename": uploaded_file.name, "size": size, "imdbID": imdb_id, "output_format": output_format},
+                            headers=headers)
+        if res.status_code != 200:
+            raise RuntimeError(f"Could not start upload: {res.text}")
+        state = uploads[resume_key] = res.json()
+
+    part_size, part_count = state["part_size"], state["part_count"]
+    read_lock = threading.Lock()
+
+    def upload_part(part_number, url):
+        with read_lock:
+            uploaded_file.seek((part_number - 1) * part_size)
+            chunk = uploaded_file.read(part_size)
+        for attempt in range(PART_RETRIES):
+            try:
+                put_res = requests.put(url, data=chunk, timeout=120)
+                if put_res.status_code == 200:
+                    return part_number, put_res.headers["ETag"]
+            except requests.RequestException:
+                pass
+            time.sleep(2 ** attempt)
+        raise RuntimeError(f"Part {part_number} failed after {PART_RETRIES} attempts; click again to resume")
+
+    todo = [n for n in range(1, part_count + 1) if n not in done]
+    progress.progress(len(done) / part_count)
+    for i in range(0, len(todo), 100):
+        batch = todo[i:i + 100]
+        res = requests.post(f"{BASE_URL}/uploads/multipart/{state['upload_id']}/parts",
+                            json={"s3_key": state["s3_key"], "part_numbers": batch}, headers=headers)
+        if res.status_code != 200:
+            raise RuntimeError(f"Could not sign upload parts: {res.text}")
+        urls = res.json()["urls"]
+        with ThreadPoolExecutor(max_workers=UPLOAD_PARALLELISM) as pool:
+            for part_number, etag in pool.map(lambda n: upload_part(n, urls[str(n)]), batch):
+                done[part_number] = etag
+                progress.progress(len(done) / part_count)
+
+    res = requests.post(f"{BASE_URL}/uploads/multipart/{state['upload_id']}/complete",
+                        json={"s3_key": state["s3_key"], "parts": [{"part_number": n, "etag": e} for n, e in done.items()]},
+                        headers=headers)
+    if res.status_code != 200:
+        raise RuntimeError(f"Could not complete upload: {res.text}")
+    del uploads[resume_key]
+    return state["s3_key"], state["job_id"]
+
+
 # ---------------- MAIN APP ----------------
 if token:
-    st_autorefresh(interval=5000, key="queue_refresh")
+    # Re-renders only; job data arrives over the event stream, so reruns make no API calls unless something changed
+    st_autorefresh(interval=2000, key="queue_refresh")
+    apply_job_events()
 
     # ---------------- UPLOAD ----------------
     st.header("Upload a Video to Queue")
     uploaded_file = st.file_uploader("Choose a video", type=["mp4", "mov", "avi"])
     imdb_id = st.text_input("IMDb ID (optional)")
+    output_label = st.selectbox("Output format", ["MP4 (1080p)", "Adaptive streaming (HLS 1080p-360p)"])
+    output_format = "hls" if output_label.startswith("Adaptive") else "mp4"
     if st.button("Add to Queue"):
         if uploaded_file:
-            res = requests.post(f"{BASE_URL}/upload-url", params={"filename": uploaded_file.name}, headers=headers)
-            if res.status_code == 200:
-                data = res.json()
-                upload_url = data["upload_url"]
-                s3_key = data["s3_key"]
-                file_id = data["file_id"]
-
-                put_res = requests.put(upload_url, data=uploaded_file.getvalue())
-                if put_res.status_code == 200:
-                    confirm = requests.post(
-                        f"{BASE_URL}/confirm-upload",
-                        params={"file_id": file_id, "s3_key": s3_key, "filename": uploaded_file.name, "imdbID": imdb_id},
-                        headers=headers
-                    )
-                    if confirm.status_code == 200:
-                        st.success("File uploaded and metadata saved!")
-                        st.rerun()
-                    else:
-                        st.error(f"Metadata save failed: {confirm.text}")
-                else:
-                    st.error(f"S3 upload failed: {put_res.text}")
-            else:
-                st.error(f"Could not get upload URL: {res.text}")
+            try:
+                # The job is created and queued from the S3 upload event; it shows up over the event stream
+                multipart_upload(uploaded_file, st.progress(0.0, text="Uploading..."), imdb_id, output_format)
+                st.success("File uploaded - transcoding starts automatically.")
+            except RuntimeError as e:
+                st.error(f"S3 upload failed: {e}")
         else:
             st.warning("Please select a file before adding to queue.")
 
     # ---------------- JOB QUEUE ----------------
     st.header("Job Queue")
-    res = requests.get(f"{BASE_URL}/jobs", headers=headers)
-    if res.status_code == 200:
-        jobs = res.json().get("jobs", [])
-        active_jobs = [job for job in jobs if job.get("status", "").lower() != "completed"]
+    if st.session_state["active_jobs"] is None:
+        res = requests.get(f"{BASE_URL}/jobs", headers=headers,
+                           params={"status": "queued,processing,failed", "limit": 100})
+        if res.status_code == 200:
+            st.session_state["active_jobs"] = res.json().get("jobs", [])
+    active_jobs = st.session_state["active_jobs"]
+    if active_jobs is not None:
 
         if not active_jobs:
             st.info("No active jobs. Upload files to add to the queue.")
@@ -220,7 +426,7 @@ if token:
                         st.session_state["show_metadata_modal"] = True
                     if cols[5].button("🗑️", key=f"del_{job['jobs_id']}"):
                         res2 = requests.delete(f"{BASE_URL}/jobs/{job['jobs_id']}", headers=headers)
-                        if res2.status_code == 200: st.success("Job deleted"); st.rerun()
+                        if res2.status_code == 200: st.success("Job deleted"); refresh_jobs(); st.rerun()
                         else: st.error("Delete failed")
 
     # ---------------- START TRANSCODING ----------------
@@ -233,6 +439,9 @@ if token:
                 st.success(f"Started {len(data['jobs'])} job(s)")
             else:
                 st.success(data.get("message", "Jobs started successfully."))
+            if data.get("failed"):
+                st.warning(f"{len(data['failed'])} job(s) could not be queued: "
+                           + ", ".join(f["jobs_id"] for f in data["failed"]))
         else:
             st.error(f"Failed to start jobs: {res.text}")
 
@@ -251,52 +460,67 @@ if token:
 
     # ---------------- ALL JOBS ----------------
     st.header("All Jobs")
-    res = requests.get(f"{BASE_URL}/jobs", headers=headers)
-    if res.status_code == 200:
-        backend_jobs = res.json().get("jobs", [])
-        if backend_jobs:
-            st.subheader("Filters & Sorting")
-            owner_filter = st.text_input("Filter by Owner:", "")
-            formats = sorted(list({os.path.splitext(job["filename"])[1] for job in backend_jobs if job.get("filename")}))
-            format_filter = st.multiselect("Filter by format", formats, default=formats)
-            statuses = ["queued", "processing", "completed", "failed"]
-            status_filter = st.multiselect("Filter by status", statuses, default=statuses)
-            sort_option = st.selectbox("Sort by", ["Created Date (Newest)", "Created Date (Oldest)", "File Name A-Z", "File Name Z-A"])
-
-            filtered_jobs = []
-            for job in backend_jobs:
-                ext = os.path.splitext(job["filename"])[1] if job.get("filename") else ""
-                status = job.get("status", "").lower()
-                owner = job.get("qut-username", "")
-                include = True
-                if owner_filter and owner_filter.lower() not in owner.lower(): include = False
-                if ext not in format_filter: include = False
-                if status not in status_filter: include = False
-                if include: filtered_jobs.append(job)
-
-            if sort_option == "File Name A-Z": filtered_jobs.sort(key=lambda x: x.get("filename", "").lower())
-            elif sort_option == "File Name Z-A": filtered_jobs.sort(key=lambda x: x.get("filename", "").lower(), reverse=True)
-            elif sort_option == "Created Date (Newest)": filtered_jobs.sort(key=lambda x: x.get("created", ""), reverse=True)
-            elif sort_option == "Created Date (Oldest)": filtered_jobs.sort(key=lambda x: x.get("created", ""))
-
-            page_size = st.number_input("Jobs per page", min_value=1, max_value=100, value=10, step=1)
-            total_jobs = len(filtered_jobs)
-            total_pages = (total_jobs + page_size - 1) // page_size
-            current_page = st.session_state.get("current_page") or 1
-
-            col_prev, col_page, col_next = st.columns([1, 2, 1])
-            with col_prev:
-                if st.button("⬅️ Previous") and current_page > 1:
-                    st.session_state["current_page"] = current_page - 1
-            with col_page: st.write(f"Page {current_page} of {total_pages}")
-            with col_next:
-                if st.button("Next ➡️") and current_page < total_pages:
-                    st.session_state["current_page"] = current_page + 1
-
-            start_idx = (current_page - 1) * page_size
-            end_idx = start_idx + page_size
-            jobs_to_display = filtered_jobs[start_idx:end_idx]
+    st.subheader("Filters & Sorting")
+    owner_filter = st.text_input("Filter by Owner (exact username):", "",
+                                 help="Matches the whole username, case-sensitively; partial names no longer match.")
+    formats = [".mp4", ".mov", ".avi"]
+    format_filter = st.multiselect("Filter by format", formats, default=formats)
+    statuses = ["queued", "processing", "completed", "failed"]
+    status_filter = st.multiselect("Filter by status", statuses, default=statuses)
+    sort_option = st.selectbox("Sort by", ["Created Date (Newest)", "Created Date (Oldest)", "File Name A-Z (this page)", "File Name Z-A (this page)"])
+    page_size = st.number_input("Jobs per page", min_value=1, max_value=100, value=10, step=1)
+
+    # Filtering, date order and paging happen server side; name sorts apply within the page
+    params = {"order": "asc" if sort_option == "Created Date (Oldest)" else "desc", "limit": page_size}
+    if owner_filter: params["owner"] = owner_filter.strip()
+    if set(format_filter) != set(formats): params["ext"] = ",".join(format_filter)
+    if set(status_filter) != set(statuses): params["status"] = ",".join(status_filter)
+
+    # Any filter change invalidates the cursors collected so far
+    if st.session_state["list_filters"] != params:
+        st.session_state["list_filters"] = params
+        st.session_state["page_cursors"] = [None]
+        st.session_state["current_page"] = 1
+    current_page = st.session_state["current_page"]
+    cursor = st.session_state["page_cursors"][current_page - 1]
+
+    page_key = [params, cursor]
+    cached = st.session_state["page_jobs"]
+    if cached is None or cached["key"] != page_key:
+        res = requests.get(f"{BASE_URL}/jobs", headers=headers, params={**params, **({"cursor": cursor} if cursor else {})})
+        cached = {"key": page_key, **res.json()} if res.status_code == 200 else None
+        st.session_state["page_jobs"] = cached
+    if cached is not None:
+        data = cached
+        # One batch request signs every finished job on the page; re-signed shortly before the links lapse
+        if "download_urls" not in cached or time.time() >= cached["download_urls_refresh"]:
+            done = [j["jobs_id"] for j in cached.get("jobs", []) if j.get("status") == "completed"]
+            dl_res = requests.post(f"{BASE_URL}/download-urls", headers=headers, json={"job_ids": done}) if done else None
+            cached["download_urls"] = dl_res.json().get("urls", {}).get("jobs", {}) if dl_res is not None and dl_res.status_code == 200 else {}
+            expiries = [presigned_expiry(u["download_url"]) for u in cached["download_urls"].values()]
+            cached["download_urls_refresh"] = min(expiries, default=float("inf")) - URL_REFRESH_MARGIN
+        jobs_to_display = data.get("jobs", [])
+        next_cursor = data.get("next_cursor")
+        if len(st.session_state["page_cursors"]) == current_page and next_cursor:
+            st.session_state["page_cursors"].append(next_cursor)
 
+        if sort_option == "File Name A-Z (this page)": jobs_to_display.sort(key=lambda x: x.get("filename", "").lower())
+        elif sort_option == "File Name Z-A (this page)": jobs_to_display.sort(key=lambda x: x.get("filename", "").lower(), reverse=True)
+
+        col_prev, col_page, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            if st.button("⬅️ Previous") and current_page > 1:
+                st.session_state["current_page"] = current_page - 1
+                st.rerun()
+        with col_page: st.write(f"Page {current_page}" + ("" if next_cursor else " (last)"))
+        with col_next:
+            if st.button("Next ➡️") and next_cursor:
+                st.session_state["current_page"] = current_page + 1
+                st.rerun()
+
+        if not jobs_to_display:
+            st.info("No jobs match these filters.")
+        else:
             header_cols = st.columns([3, 2, 2, 2, 2])
             header_cols[0].markdown("**File Name**")
             header_cols[1].markdown("**Owner**")
@@ -316,12 +540,18 @@ if token:
                 elif status == "failed": cols[3].write("🔴 Error")
                 else: cols[3].write(status)
 
-                if status == "completed":
+                signed = data["download_urls"].get(job["jobs_id"])
+                if status == "completed" and signed:
+                    label = "HLS playlist" if signed.get("format") == "hls" else "Download"
+                    cols[4].markdown(f"[{label}]({signed['download_url']})")
+                elif status == "completed":
                     if cols[4].button("Download", key=f"dl_{job['jobs_id']}"):
                         dl_res = requests.get(f"{BASE_URL}/download/{job['jobs_id']}", headers=headers)
                         if dl_res.status_code == 200:
                             download_url = dl_res.json().get("download_url")
-                            if download_url:
+                            if dl_res.json().get("format") == "hls":
+                                st.markdown(f"[Open HLS master playlist]({download_url})", unsafe_allow_html=True)
+                            elif download_url:
                                 st.markdown(f"[Click here to download your file]({download_url})", unsafe_allow_html=True)
                             else:
                                 st.error("No download URL returned")
@@ -334,6 +564,7 @@ if token:
                     res2 = requests.delete(f"{BASE_URL}/jobs/{job['jobs_id']}", headers=headers)
                     if res2.status_code == 200:
                         st.success("Job deleted")
+                        refresh_jobs()
                         st.rerun()
                     else:
                         st.error("Delete failed")
@@ -0,0 +1,127 @@
+import os, re, uuid
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+# DynamoDB rows and queue messages for an uploaded video, shared by the API
+# (/confirm-upload, /jobs/start) and the worker's S3 ingest so both write the same thing
+
+OUTPUT_FORMATS = ("mp4", "hls")
+
+# Upper bounds in "1080p-seconds" (duration scaled by pixel count), or source bytes when not probed
+SIZE_CLASS_WORK = {"small": 60, "medium": 600}
+SIZE_CLASS_BYTES = {"small": 50 * 1024 * 1024, "medium": 500 * 1024 * 1024}
+
+# Uploads land at "uploads/<username>/<file_id>_<filename>". Outputs, HLS renditions
+# and segments live outside this prefix, which the bucket notification filters on
+UPLOAD_PREFIX = "uploads/"
+UPLOAD_KEY = re.compile(r"^uploads/(?P<user>[^/]+)/(?P<file_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})_(?P<filename>[^/]+)$")
+_JOB_NAMESPACE = uuid.UUID("6f1c7e0a-3b7d-4c55-9a43-0d9e2f6b8c21")
+
+
+def upload_key(username: str, file_id: str, filename: str) -> str:
+    return f"{UPLOAD_PREFIX}{username}/{file_id}_{filename}"
+
+
+def owns_upload(username: str, s3_key: str) -> bool:
+    """Whether s3_key is one of username's uploads, i.e. exactly uploads/<username>/<file_id>_<filename>.
+
+    Keys outside uploads/ never qualify: they hold outputs, HLS files and segments,
+    and a bare "<username>/" prefix would let a user named "uploads" or "segments"
+    claim everyone's objects.
+    """
+    match = UPLOAD_KEY.match(s3_key)
+    return bool(match) and match["user"] == username
+
+
+def job_id_for(file_id: str) -> str:
+    """The job id of an upload's transcode; deterministic so every path creating it agrees."""
+    return str(uuid.uuid5(_JOB_NAMESPACE, file_id))
+
+
+def upload_metadata(filename: str, imdb_id: str = "", output_format: str = "mp4") -> dict:
+    """S3 user metadata (x-amz-meta-*) that carries the job details to the ingest worker."""
+    # Metadata values must be ASCII
+    return {"filename": quote(filename), "imdbid": imdb_id or "", "output-format": output_format}
+
+
+def parse_upload(s3_key: str, metadata: dict):
+    """(username, file_id, filename, imdb_id, output_format) for an upload key, or None for other objects."""
+    match = UPLOAD_KEY.match(s3_key)
+    if not match:
+        return None
+    output_format = metadata.get("output-format", "mp4")
+    if output_format not in OUTPUT_FORMATS:
+        output_format = "mp4"
+    filename = unquote(metadata["filename"]) if metadata.get("filename") else match["filename"]
+    return match["user"], match["file_id"], filename, metadata.get("imdbid", ""), output_format
+
+
+def media_attributes(media: dict) -> dict:
+    """Probe results as DynamoDB attributes (audio_codec is omitted for silent videos)"""
+    attrs = {}
+    for key, value in media.items():
+        if value is None:
+            continue
+        attrs[key] = {"N": str(value)} if isinstance(value, (int, float)) else {"S": str(value)}
+    return attrs
+
+
+def upload_item(username, file_id, filename, s3_key, imdb_id, media) -> dict:
+    return {
+        "qut-username": {"S": username},
+        "file_id": {"S": file_id},
+        "filename": {"S": filename},
+        "uploaded": {"S": datetime.utcnow().isoformat()},
+        "imdbID": {"S": imdb_id or ""},
+        "s3_key": {"S": s3_key},
+        **media_attributes(media),
+    }
+
+
+def job_item(username, file_id, filename, s3_key, output_format, media) -> dict:
+    attrs = media_attributes(media)
+    return {
+        "qut-username": {"S": username},
+        "jobs_id": {"S": job_id_for(file_id)},
+        "file_id": {"S": file_id},
+        "filename": {"S": filename},
+        "extension": {"S": os.path.splitext(filename)[1].lower()},
+        "s3_key": {"S": s3_key},
+        "status": {"S": "queued"},
+        "output_format": {"S": output_format},
+        "created": {"S": datetime.utcnow().isoformat()},
+        # Used for size-class routing and ETAs
+        "duration": attrs["duration"],
+        "width": attrs["width"],
+        "height": attrs["height"],
+    }
+
+
+def size_class(work=None, size_bytes=None) -> str:
+    """Queue for a job from its work in 1080p-seconds, or from the source size when it wasn't probed."""
+    limits = SIZE_CLASS_WORK if work is not None else SIZE_CLASS_BYTES
+    amount = work if work is not None else size_bytes
+    for name in ("small", "medium"):
+        if amount < limits[name]:
+            return name
+    return "large"
+
+
+def job_work(item: dict) -> float:
+    """Duration scaled by pixel count; raises KeyError/ValueError for jobs without probe data."""
+    duration = float(item["duration"]["N"])
+    pixels = int(item.get("width", {}).get("N", 1920)) * int(item.get("height", {}).get("N", 1080))
+    return duration * pixels / (1920 * 1080)
+
+
+def job_message(username: str, item: dict) -> dict:
+    msg = {
+        "username": username,
+        "jobs_id": item["jobs_id"]["S"],
+        "s3_key": item["s3_key"]["S"],
+        "output_format": item.get("output_format", {}).get("S", "mp4"),
+    }
+    # Probed at upload; saves the worker an ffprobe for ETAs and segmenting
+    if "duration" in item:
+        msg["duration"] = float(item["duration"]["N"])
+    return msg
@@ -1,20 +1,43 @@
-import os, uuid, asyncio, subprocess, boto3
+import os, uuid, asyncio, subprocess, base64
 import json
+from boto3.dynamodb.types import TypeDeserializer
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from repository import AsyncClient, Table, gather_limited
 from auth import get_current_user, is_admin
+from changefeed import JobChangeFeed
+from response_cache import response_cache
+import jobrecords
 
 router = APIRouter(tags=["jobs"])
 
 # ---------------- AWS CONFIG ----------------
-REGION = "ap-southeast-2"
 JOBS_TABLE = "n10893997-a2-jobs3"
+CACHE_TABLE = "n10893997-a3-transcode-cache"
 S3_BUCKET = "n10893997-videos"
 SQS_QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n10893997-sqs-a3"
+# Size-class queues so short clips don't wait behind long transcodes ("medium" is the original queue)
+SQS_QUEUES = {
+    "small": "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n10893997-sqs-a3-small",
+    "medium": SQS_QUEUE_URL,
+    "large": "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n10893997-sqs-a3-large",
+}
 
-dynamodb = boto3.client("dynamodb", region_name=REGION)
-s3_client = boto3.client("s3", region_name=REGION)
-sqs = boto3.client("sqs", region_name=REGION)
+# start_jobs: SQS batch limit, and how many AWS calls it keeps in flight at once
+SQS_BATCH_SIZE = 10
+START_CONCURRENCY = 16
+
+# "stream": ffmpeg reads the source via a presigned URL, "download": copy to data/input first
+INPUT_MODE = os.getenv("INPUT_MODE", "stream")
+STREAM_URL_EXPIRY = 6 * 3600
+
+# Async data access; nothing below blocks the event loop on AWS
+jobs_table = Table(JOBS_TABLE, ("qut-username", "jobs_id"))
+dynamodb = AsyncClient("dynamodb")
+s3_client = AsyncClient("s3")
+sqs = AsyncClient("sqs")
 
 
 # ---------------- JOB RUNNER ----------------
@@ -29,9 +52,8 @@ async def run_job(jobs_id: str, username: str, s3_key: str):
 
     try:
         # Mark job as processing
-        dynamodb.update_item(
-            TableName=JOBS_TABLE,
-            Key={"qut-username": {"S": username}, "jobs_id": {"S": jobs_id}},
+        await jobs_table.update(
+            username, jobs_id,
             UpdateExpression="SET #st = :s, started = :t",
             ExpressionAttributeNames={"#st": "status"},
             ExpressionAttributeValues={
@@ -40,14 +62,23 @@ async def run_job(jobs_id: str, username: str, s3_key: str):
             },
         )
 
-        # Download input file from S3
-        input_path = os.path.join("data", "input", original_name)
-        os.makedirs(os.path.dirname(input_path), exist_ok=True)
-        s3_client.download_file(S3_BUCKET, s3_key, input_path)
+        # Input: presigned URL so ffmpeg starts decoding immediately, or a full download
+        if INPUT_MODE == "stream":
+            input_path = s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": S3_BUCKET, "Key": s3_key},
+                ExpiresIn=STREAM_URL_EXPIRY,
+            )
+            input_opts = ["-reconnect", "1", "-reconnect_on_network_error", "1", "-reconnect_delay_max", "5"]
+        else:
+            input_path = os.path.join("data", "input", original_name)
+            os.makedirs(os.path.dirname(input_path), exist_ok=True)
+            await s3_client.download_file(S3_BUCKET, s3_key, input_path)
+            input_opts = []
 
         # Run ffmpeg asynchronously (use all CPU threads to trigger autoscaling faster)
         process = await asyncio.create_subprocess_exec(
-            "ffmpeg", "-y", "-i", input_path,
+            "ffmpeg", "-y", *input_opts, "-i", input_path,
             "-c:v", "libx264",
             "-preset", "medium",   # "medium" or "slow" = higher CPU usage
             "-threads", "0",       # use all available cores
@@ -70,12 +101,11 @@ async def run_job(jobs_id: str, username: str, s3_key: str):
 
         # Upload transcoded file to S3
         output_s3_key = f"{username}/{output_filename}"
-        s3_client.upload_file(output_path, S3_BUCKET, output_s3_key)
+        await s3_client.upload_file(output_path, S3_BUCKET, output_s3_key)
 
         # Mark job as completed
-        dynamodb.update_item(
-            TableName=JOBS_TABLE,
-            Key={"qut-username": {"S": username}, "jobs_id": {"S": jobs_id}},
+        await jobs_table.update(
+            username, jobs_id,
             UpdateExpression="SET #st = :s, #out = :o, finished = :f",
             ExpressionAttributeNames={
                 "#st": "status",
@@ -90,9 +120,8 @@ async def run_job(jobs_id: str, username: str, s3_key: str):
 
     except Exception as e:
         # Mark job as failed
-        dynamodb.update_item(
-            TableName=JOBS_TABLE,
-            Key={"qut-username": {"S": username}, "jobs_id": {"S": jobs_id}},
+        await jobs_table.update(
+            username, jobs_id,
             UpdateExpression="SET #st = :s, #err = :e, finished = :f",
             ExpressionAttributeNames={
                 "#st": "status",
@@ -107,47 +136,106 @@ async def run_job(jobs_id: str, username: str, s3_key: str):
 
 
 # ---------------- START JOBS ----------------
+async def _size_class(item: dict) -> str:
+    """Pick the queue for a job from its source duration and resolution (object size as a fallback)"""
+    try:
+        return jobrecords.size_class(work=jobrecords.job_work(item))
+    except (KeyError, ValueError):
+        head = await s3_client.head_object(Bucket=S3_BUCKET, Key=item["s3_key"]["S"])
+        return jobrecords.size_class(size_bytes=head["ContentLength"])
+
+async def _queued_items(username: str) -> list:
+    """A user's 'queued' jobs not yet sent to SQS (every page of the query).
+
+    Jobs enqueued by the S3 ingest or an earlier start already have queued_at.
+    """
+    return await jobs_table.query_all(
+        KeyConditionExpression="#u = :u",
+        FilterExpression="#s = :q AND attribute_not_exists(queued_at)",
+        ExpressionAttributeNames={"#u": "qut-username", "#s": "status"},
+        ExpressionAttributeValues={":u": {"S": username}, ":q": {"S": "queued"}},
+    )
+
+
+async def _send_batch(queue_url: str, msgs: list) -> list:
+    """send_message_batch for up to 10 messages; returns [(jobs_id, error)] for entries SQS rejected"""
+    resp = await sqs.send_message_batch(
+        QueueUrl=queue_url,
+        Entries=[{"Id": str(i), "MessageBody": json.dumps(m)} for i, m in enumerate(msgs)],
+    )
+    return [(msgs[int(f["Id"])]["jobs_id"], f.get("Message", f.get("Code", "send failed"))) for f in resp.get("Failed", [])]
+
+
+async def _mark_enqueued(username: str, jobs_id: str, size_class: str, queued_at: str):
+    await jobs_table.update(
+        username, jobs_id,
+        UpdateExpression="SET #s = :s, queued_at = :t, size_class = :c",
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={
+            ":s": {"S": "queued"},
+            ":t": {"S": queued_at},
+            ":c": {"S": size_class},
+        },
+    )
+
+
 @router.post("/jobs/start")
 async def start_jobs(user=Depends(get_current_user)):
-    """Queue all 'queued' jobs into SQS for the worker to process."""
+    """Queue all 'queued' jobs into SQS for the worker to process.
+
+    Messages go out 10 per send_message_batch and the status writes run
+    concurrently on the AWS I/O pool; jobs that couldn't be enqueued, or whose
+    status write failed after sending, are listed under "failed" with the reason.
+    """
     try:
-        resp = dynamodb.query(
-            TableName=JOBS_TABLE,
-            KeyConditionExpression="#u = :u",
-            ExpressionAttributeNames={"#u": "qut-username"},
-            ExpressionAttributeValues={":u": {"S": user["cognito:username"]}},
-        )
-        items = resp.get("Items", [])
-        sent = 0
-
-        for item in items:
-            status = item.get("status", {}).get("S", "")
-            if status == "queued":
-                jobs_id = item["jobs_id"]["S"]
-                s3_key = item["s3_key"]["S"]
-
-                msg = {
-                    "username": user["cognito:username"],
-                    "jobs_id": jobs_id,
-                    "s3_key": s3_key,
-                }
-
-                sqs.send_message(QueueUrl=SQS_QUEUE_URL, MessageBody=json.dumps(msg))
-
-                # Optional: update DynamoDB status
-                dynamodb.update_item(
-                    TableName=JOBS_TABLE,
-                    Key={"qut-username": {"S": user["cognito:username"]}, "jobs_id": {"S": jobs_id}},
-                    UpdateExpression="SET #s = :s, queued_at = :t",
-                    ExpressionAttributeNames={"#s": "status"},
-                    ExpressionAttributeValues={
-                        ":s": {"S": "queued"},
-                        ":t": {"S": datetime.utcnow().isoformat()},
-                    },
-                )
-                sent += 1
-
-        return {"message": f"{sent} jobs sent to SQS for processing"}
+        username = user["cognito:username"]
+        items = await _queued_items(username)
+
+        # Size classes may need a head_object each, so resolve them concurrently too
+        classes = await gather_limited([_size_class(item) for item in items], START_CONCURRENCY)
+        failed = []
+        by_queue = {}
+        for item, size_class in zip(items, classes):
+            if isinstance(size_class, Exception):
+                failed.append({"jobs_id": item["jobs_id"]["S"], "error": str(size_class)})
+                continue
+            by_queue.setdefault(size_class, []).append(jobrecords.job_message(username, item))
+
+        batches = [
+            (size_class, msgs[i:i + SQS_BATCH_SIZE])
+            for size_class, msgs in by_queue.items()
+            for i in range(0, len(msgs), SQS_BATCH_SIZE)
+        ]
+        results = await gather_limited([_send_batch(SQS_QUEUES[c], msgs) for c, msgs in batches], START_CONCURRENCY)
+
+        sent = []
+        for (size_class, msgs), result in zip(batches, results):
+            if isinstance(result, Exception):
+                failed += [{"jobs_id": m["jobs_id"], "error": str(result)} for m in msgs]
+                continue
+            rejected = dict(result)
+            failed += [{"jobs_id": j, "error": e} for j, e in result]
+            sent += [(m["jobs_id"], size_class) for m in msgs if m["jobs_id"] not in rejected]
+
+        # The message is already on the queue, but without queued_at the next start would send it again
+        queued_at = datetime.utcnow().isoformat()
+        writes = await gather_limited([_mark_enqueued(username, j, c, queued_at) for j, c in sent], START_CONCURRENCY)
+        unmarked = set()
+        for (jobs_id, _), result in zip(sent, writes):
+            if isinstance(result, Exception):
+                print(f"[ERROR] Status update for job {jobs_id} failed: {result}")
+                failed.append({"jobs_id": jobs_id, "error": f"Sent to SQS but status update failed: {result}"})
+                unmarked.add(jobs_id)
+        sent = [(j, c) for j, c in sent if j not in unmarked]
+
+        response_cache.invalidate(username)
+        if failed:
+            print(f"[ERROR] {len(failed)} job(s) for {username} could not be queued")
+        return {
+            "message": f"{len(sent)} jobs sent to SQS for processing",
+            "sent": [j for j, _ in sent],
+            "failed": failed,
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 # @router.post("/jobs/start")
@@ -179,90 +267,372 @@ async def start_jobs(user=Depends(get_current_user)):
 
 
 # ---------------- LIST JOBS ----------------
+# GSIs on the jobs table (see JobsTable in iac-template.yaml)
+STATUS_INDEX = "status-created-index"    # status / created: admin listing by status
+USER_INDEX = "user-created-index"        # qut-username / created: one user's jobs by date
+JOB_STATUSES = ("queued", "processing", "completed", "failed")
+LIST_ATTRIBUTES = ["qut-username", "jobs_id", "filename", "extension", "status", "created",
+                   "finished", "output", "output_format", "error"]
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+def _encode_cursor(positions: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(positions, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(positions, dict):
+            raise ValueError
+        return positions
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _csv_param(value: Optional[str]) -> list:
+    return [v.strip() for v in value.split(",") if v.strip()] if value else []
+
+
+def _list_partitions(owner, statuses):
+    """One index partition per query the page is merged from: name -> (index, partition key, key attrs)"""
+    if owner:
+        return {"user": (USER_INDEX, ("qut-username", owner), ["qut-username", "created", "jobs_id"])}
+    # Admin listing of everyone: each status is its own partition of the status index
+    return {
+        status: (STATUS_INDEX, ("status", status), ["status", "created", "qut-username", "jobs_id"])
+        for status in (statuses or JOB_STATUSES)
+    }
+
+
+async def _query_partition(index, partition, start_key, page_size, ascending, created_from, created_to, filters):
+    """Up to page_size matching items from one index partition, after start_key. Returns (items, exhausted)"""
+    names = {"#pk": partition[0]}
+    values = {":pk": {"S": partition[1]}}
+    key_condition = "#pk = :pk"
+    if created_from or created_to:
+        names["#c"] = "created"
+    if created_from and created_to:
+        key_condition += " AND #c BETWEEN :cf AND :ct"
+        values.update({":cf": {"S": created_from}, ":ct": {"S": created_to}})
+    elif created_from:
+        key_condition += " AND #c >= :cf"
+        values[":cf"] = {"S": created_from}
+    elif created_to:
+        key_condition += " AND #c <= :ct"
+        values[":ct"] = {"S": created_to}
+
+    kwargs = {}
+    filter_parts = []
+    for attr, wanted in filters.items():
+        if not wanted:
+            continue
+        alias = attr.replace("-", "_")
+        names[f"#{alias}"] = attr
+        placeholders = []
+        for i, value in enumerate(wanted):
+            values[f":{alias}{i}"] = {"S": value}
+            placeholders.append(f":{alias}{i}")
+        filter_parts.append(f"#{alias} IN ({', '.join(placeholders)})")
+    if filter_parts:
+        kwargs["FilterExpression"] = " AND ".join(filter_parts)
+    if start_key:
+        kwargs["ExclusiveStartKey"] = start_key
+
+    projection = []
+    for i, attr in enumerate(LIST_ATTRIBUTES):
+        names[f"#a{i}"] = attr
+        projection.append(f"#a{i}")
+
+    items = []
+    while True:
+        resp = await jobs_table.query(
+            IndexName=index,
+            KeyConditionExpression=key_condition,
+            ProjectionExpression=", ".join(projection),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ScanIndexForward=ascending,
+            Limit=page_size,
+            **kwargs,
+        )
+        items += resp.get("Items", [])
+        if "LastEvaluatedKey" not in resp:
+            return items, True
+        if len(items) >= page_size:
+            return items, False
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
 @router.get("/jobs")
-async def list_jobs(user=Depends(get_current_user)):
-    """List jobs. Admins see all, users see only their own"""
+async def list_jobs(
+    request: Request,
+    status: Optional[str] = None,
+    ext: Optional[str] = None,
+    owner: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    order: str = "desc",
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    user=Depends(get_current_user),
+):
+    """One page of jobs, newest first by default. Admins see all, users see only their own.
+
+    status and ext take comma-separated lists, created_from/created_to are ISO
+    timestamps, and next_cursor is passed back as cursor for the following page.
+    """
     try:
-        if is_admin(user):
-            print(f"[DEBUG] {user['cognito:username']} is ADMIN → scan")
-            resp = dynamodb.scan(TableName=JOBS_TABLE)
-        else:
-            print(f"[DEBUG] {user['cognito:username']} is NORMAL USER → query")
-            resp = dynamodb.query(
-                TableName=JOBS_TABLE,
-                KeyConditionExpression="#u = :u",
-                ExpressionAttributeNames={"#u": "qut-username"},
-                ExpressionAttributeValues={":u": {"S": user["cognito:username"]}},
+        if not is_admin(user):
+            owner = user["cognito:username"]
+        statuses = _csv_param(status)
+        if set(statuses) - set(JOB_STATUSES):
+            raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(JOB_STATUSES)}")
+        if order not in ("asc", "desc"):
+            raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'")
+        page_size = max(1, min(limit, MAX_PAGE_SIZE))
+        ascending = order == "asc"
+        # Extension filter; older jobs without the attribute never match it
+        filters = {"extension": [e if e.startswith(".") else f".{e}" for e in _csv_param(ext)]}
+        if owner:
+            filters["status"] = statuses
+
+        async def build():
+            partitions = _list_partitions(owner, statuses)
+            positions = _decode_cursor(cursor) if cursor else {name: None for name in partitions}
+
+            if set(positions) - set(partitions):
+                raise HTTPException(status_code=400, detail="Cursor does not match these filters")
+
+            # Each partition is already sorted by created, so query them concurrently and merge their heads
+            fetched = dict(zip(positions, await asyncio.gather(*(
+                _query_partition(*partitions[name][:2], start_key, page_size, ascending,
+                                 created_from, created_to, filters)
+                for name, start_key in positions.items()
+            ))))
+            merged = sorted(
+                ((item["created"]["S"], item["jobs_id"]["S"], name, item)
+                 for name, (items, _) in fetched.items() for item in items),
+                reverse=not ascending,
             )
-
-        jobs = [{k: list(v.values())[0] for k, v in item.items()} for item in resp.get("Items", [])]
-        return {"jobs": jobs}
+            page = merged[:page_size]
+
+            next_positions = {}
+            for name, (items, exhausted) in fetched.items():
+                taken = [item for _, _, n, item in page if n == name]
+                if exhausted and len(taken) == len(items):
+                    continue
+                key_attrs = partitions[name][2]
+                next_positions[name] = {k: taken[-1][k] for k in key_attrs} if taken else positions[name]
+
+            print(f"[DEBUG] {user['cognito:username']} listed {len(page)} job(s) from {len(partitions)} partition(s)")
+            jobs = [{k: list(v.values())[0] for k, v in item.items()} for *_, item in page]
+            return {"jobs": jobs, "next_cursor": _encode_cursor(next_positions) if next_positions else None}
+
+        # Cached per user; an admin view over everyone is invalidated by any owner's change
+        return await response_cache.respond(request, user["cognito:username"], build, scopes=[owner or "*"])
+    except HTTPException:
+        raise
     except Exception as e:
         print("[ERROR] /jobs failed:", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ---------------- JOB EVENTS ----------------
+# Fed by the jobs table's DynamoDB Stream, so worker status writes reach clients without polling
+SSE_KEEPALIVE = 15
+job_feed = JobChangeFeed(JOBS_TABLE, LIST_ATTRIBUTES)
+
+
+def _invalidate_on_change(event):
+    # Worker status writes reach this process only through the feed
+    if event["type"] != "progress":
+        response_cache.invalidate(event["owner"])
+
+job_feed.add_listener(_invalidate_on_change)
+
+
+@router.get("/jobs/events")
+async def job_events(request: Request, user=Depends(get_current_user)):
+    """Server-Sent Events stream of job changes. Admins get every job, users only their own"""
+    # Only the few processes holding a stream reader slot can serve events
+    if not job_feed.live():
+        raise HTTPException(status_code=503, detail="Job events unavailable, poll GET /jobs instead")
+    queue = job_feed.subscribe(None if is_admin(user) else user["cognito:username"])
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if not job_feed.live():
+                        # Lost the reader slot: end the stream so the client reconnects (and falls back to polling)
+                        return
+                    # Comment line keeps proxies and the ALB from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, default=float)}\n\n"
+        finally:
+            job_feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ---------------- JOB LOOKUP ----------------
+JOB_ID_INDEX = "jobs-id-index"  # jobs_id -> owner, KEYS_ONLY
+
+
+async def job_owner(jobs_id: str) -> Optional[str]:
+    """Owner of a job, read from the jobs_id index instead of scanning the table"""
+    resp = await jobs_table.query(
+        IndexName=JOB_ID_INDEX,
+        KeyConditionExpression="jobs_id = :j",
+        ExpressionAttributeValues={":j": {"S": jobs_id}},
+    )
+    items = resp.get("Items", [])
+    return items[0]["qut-username"]["S"] if items else None
+
+
+async def find_job(jobs_id: str, user: dict, **get_kwargs) -> Optional[dict]:
+    """A job item by id, or None. Admins can address anyone's job, users only their own.
+
+    Extra kwargs (e.g. ProjectionExpression) go to get_item.
+    """
+    owner = user["cognito:username"]
+    if is_admin(user):
+        owner = await job_owner(jobs_id)
+        if not owner:
+            return None
+
+    return await jobs_table.get(owner, jobs_id, **get_kwargs)
+
+
+# ---------------- JOB PROGRESS ----------------
+@router.get("/jobs/{jobs_id}/progress")
+async def get_job_progress(jobs_id: str, user=Depends(get_current_user)):
+    """Latest progress record written by the worker (pass, frame, fps, speed, ETA)"""
+    try:
+        job = await find_job(
+            jobs_id, user,
+            ProjectionExpression="#s, progress, segments_total, segments_done",
+            ExpressionAttributeNames={"#s": "status"},
+        )
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+
+        item = {k: TypeDeserializer().deserialize(v) for k, v in job.items()}
+        status = item.get("status", "unknown")
+        progress = item.get("progress") or {}
+        if status == "completed":
+            progress.update({"percent": 100, "eta_seconds": 0})
+
+        result = {"jobs_id": jobs_id, "status": status, "progress": progress}
+        # Segmented jobs report how many segments are encoded
+        if "segments_total" in item:
+            result["segments_total"] = item["segments_total"]
+            result["segments_done"] = len(item.get("segments_done", ()))
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # ---------------- DELETE JOB ----------------
+async def _delete_output(output_key: str):
+    """Delete a job's output; HLS outputs are a whole directory of playlists and segments"""
+    if not output_key.endswith(".m3u8"):
+        await s3_client.delete_object(Bucket=S3_BUCKET, Key=output_key)
+        return
+    prefix = output_key.rsplit("/", 1)[0] + "/"
+    kwargs = {}
+    while True:
+        page = await s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix, **kwargs)
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            await s3_client.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": keys, "Quiet": True})
+        if not page.get("IsTruncated"):
+            return
+        kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+async def _release_output(job: dict):
+    """Drop a job's reference to its output and delete it once no other job uses it"""
+    if "output" not in job:
+        return
+    output_key = job["output"]["S"]
+    if "cache_key" not in job:
+        await _delete_output(output_key)
+        return
+
+    cache_key = {"cache_key": {"S": job["cache_key"]["S"]}}
+    try:
+        resp = await dynamodb.update_item(
+            TableName=CACHE_TABLE,
+            Key=cache_key,
+            UpdateExpression="ADD refcount :neg",
+            ConditionExpression="attribute_exists(cache_key)",
+            ExpressionAttributeValues={":neg": {"N": "-1"}},
+            ReturnValues="UPDATED_NEW",
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # Cache entry already gone, nothing else can be sharing the object
+        await _delete_output(output_key)
+        return
+
+    remaining = int(resp["Attributes"]["refcount"]["N"])
+    if remaining > 0:
+        print(f"[DEBUG] Output {output_key} still used by {remaining} job(s), keeping it")
+        return
+    # refcount 0 blocks new cache hits, so the entry and object can go
+    await dynamodb.delete_item(TableName=CACHE_TABLE, Key=cache_key)
+    await _delete_output(output_key)
+
+
 @router.delete("/jobs/{jobs_id}")
-def delete_job(jobs_id: str, user=Depends(get_current_user)):
+async def delete_job(jobs_id: str, user=Depends(get_current_user)):
     """Delete a job. Admins can delete any, users only their own"""
     try:
         if is_admin(user):
-            # Admin: find owner first
-            resp = dynamodb.scan(
-                TableName=JOBS_TABLE,
-                FilterExpression="jobs_id = :j",
-                ExpressionAttributeValues={":j": {"S": jobs_id}},
-            )
-            items = resp.get("Items", [])
-            if not items:
+            # Admin: owner comes from the jobs_id index
+            job = await find_job(jobs_id, user)
+            if not job:
                 raise HTTPException(status_code=404, detail="Job not found")
-            job = items[0]
             owner = job["qut-username"]["S"]
 
             # Delete from DynamoDB
-            dynamodb.delete_item(
-                TableName=JOBS_TABLE,
-                Key={"qut-username": {"S": owner}, "jobs_id": {"S": jobs_id}},
-            )
+            await jobs_table.delete(owner, jobs_id)
 
             # Delete files from S3 if present
             if "s3_key" in job:
-                s3_client.delete_object(Bucket=S3_BUCKET, Key=job["s3_key"]["S"])
-            if "output" in job:
-                s3_client.delete_object(Bucket=S3_BUCKET, Key=job["output"]["S"])
+                await s3_client.delete_object(Bucket=S3_BUCKET, Key=job["s3_key"]["S"])
+            await _release_output(job)
+            response_cache.invalidate(owner)
 
             print(f"[DEBUG] Admin {user['cognito:username']} deleted job {jobs_id}")
             return {"message": f"Admin deleted job {jobs_id} successfully"}
 
         else:
             # Normal user: only delete their own job
-            resp = dynamodb.get_item(
-                TableName=JOBS_TABLE,
-                Key={
-                    "qut-username": {"S": user["cognito:username"]},
-                    "jobs_id": {"S": jobs_id},
-                },
-            )
-            if "Item" not in resp:
+            job = await jobs_table.get(user["cognito:username"], jobs_id)
+            if not job:
                 raise HTTPException(status_code=403, detail="You cannot delete jobs that aren't yours")
 
-            job = resp["Item"]
-
             # Delete from DynamoDB
-            dynamodb.delete_item(
-                TableName=JOBS_TABLE,
-                Key={
-                    "qut-username": {"S": user["cognito:username"]},
-                    "jobs_id": {"S": jobs_id},
-                },
-            )
+            await jobs_table.delete(user["cognito:username"], jobs_id)
 
             # Delete files from S3 if present
             if "s3_key" in job:
-                s3_client.delete_object(Bucket=S3_BUCKET, Key=job["s3_key"]["S"])
-            if "output" in job:
-                s3_client.delete_object(Bucket=S3_BUCKET, Key=job["output"]["S"])
+                await s3_client.delete_object(Bucket=S3_BUCKET, Key=job["s3_key"]["S"])
+            await _release_output(job)
+            response_cache.invalidate(user["cognito:username"])
 
             print(f"[DEBUG] User {user['cognito:username']} deleted job {jobs_id}")
             return {"message": f"Job {jobs_id} deleted successfully"}
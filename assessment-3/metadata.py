@@ -1,23 +1,27 @@
-import boto3
-from fastapi import APIRouter, Depends, HTTPException
+from boto3.dynamodb.types import TypeDeserializer
+from fastapi import APIRouter, Depends, HTTPException, Request
+from repository import Table
 from auth import get_current_user
+from response_cache import response_cache
 
 router = APIRouter(tags=["metadata"])
 
-REGION = "ap-southeast-2"
 UPLOADS_TABLE = "n10893997-a2"
-dynamodb = boto3.client("dynamodb", region_name=REGION)
+uploads_table = Table(UPLOADS_TABLE, ("qut-username", "file_id"))
 
 @router.get("/files/{file_id}/full_metadata")
-def get_file_metadata(file_id: str, user=Depends(get_current_user)):
+async def get_file_metadata(file_id: str, request: Request, user=Depends(get_current_user)):
+    """Upload record including the probe results (duration, codecs, resolution, bitrate, frame rate)"""
     try:
-        resp = dynamodb.get_item(
-            TableName=UPLOADS_TABLE,
-            Key={"qut-username": {"S": user["cognito:username"]}, "file_id": {"S": file_id}},
-        )
-        if "Item" not in resp:
-            raise HTTPException(status_code=404, detail="File not found")
-        item = {k: list(v.values())[0] for k, v in resp["Item"].items()}
-        return item
+        async def build():
+            item = await uploads_table.get(user["cognito:username"], file_id)
+            if not item:
+                raise HTTPException(status_code=404, detail="File not found")
+            deserializer = TypeDeserializer()
+            return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+        return await response_cache.respond(request, user["cognito:username"], build)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
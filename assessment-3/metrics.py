@@ -0,0 +1,145 @@
+import time, threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers fast AWS calls up to hour-long transcodes
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(key)} {_fmt(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # label key -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            data = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, data in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, data):
+                    lines.append(f"{self.name}_bucket{_labels(key + (('le', _fmt(bound)),))} {count}")
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {data[-1]}")
+                lines.append(f"{self.name}_sum{_labels(key)} {_fmt(data[-2])}")
+                lines.append(f"{self.name}_count{_labels(key)} {data[-1]}")
+        return lines
+
+
+# ---------------- REGISTRY ----------------
+_metrics = []
+
+def counter(name, help_text):
+    metric = Counter(name, help_text)
+    _metrics.append(metric)
+    return metric
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help_text, buckets)
+    _metrics.append(metric)
+    return metric
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# ---------------- AWS CALL TIMING ----------------
+AWS_CALL_SECONDS = histogram("aws_call_seconds", "Latency of individual AWS API calls")
+AWS_CALL_ERRORS = counter("aws_call_errors_total", "AWS API calls that returned an error")
+
+def instrument_client(client):
+    """Time every API call a boto3 client makes, labelled by service and operation."""
+    service = client.meta.service_model.service_name
+
+    def before(context, **kwargs):
+        context["metrics_start"] = time.monotonic()
+
+    def after(model, context, parsed, **kwargs):
+        start = context.get("metrics_start")
+        if start is None:
+            return
+        AWS_CALL_SECONDS.observe(time.monotonic() - start, service=service, operation=model.name)
+        if parsed.get("Error"):
+            AWS_CALL_ERRORS.inc(service=service, operation=model.name)
+
+    client.meta.events.register(f"before-call.{service}", before)
+    client.meta.events.register(f"after-call.{service}", after)
+    return client
+
+
+# ---------------- HTTP ENDPOINT ----------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes would flood the worker log
+
+def serve(port):
+    """Serve /metrics on a background thread."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _labels(key):
+    if not key:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in key)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + "}"
+
+def _fmt(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -0,0 +1,92 @@
+import json, subprocess
+
+# ffprobe only needs the container header; keep reads (ranged HTTP requests
+# against a presigned URL) and analysis small so probing takes a second or two
+PROBE_SIZE = 5 * 1024 * 1024
+PROBE_TIMEOUT = 30
+
+
+# ffprobe read the bytes but they aren't a media container it understands;
+# any other failure (403, network, timeout) says nothing about the file
+UNPARSEABLE_MARKERS = ("Invalid data found when processing input", "moov atom not found")
+
+
+class ProbeError(Exception):
+    """The file is not a playable video."""
+
+
+class ProbeUnavailable(Exception):
+    """The file couldn't be read right now (timeout, network or permission error); try again later."""
+
+
+def probe_media(url: str) -> dict:
+    """Read the container header of a local path or presigned S3 URL with ffprobe.
+
+    Returns duration, codecs, resolution, bitrate and frame rate. Raises
+    ProbeError only when the file was read and is not a usable video, and
+    ProbeUnavailable when it couldn't be read, so callers never discard a
+    file over a transient failure.
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-probesize", str(PROBE_SIZE),
+        "-analyzeduration", "5000000",
+        "-print_format", "json",
+        "-show_format", "-show_streams",
+        url,
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ProbeUnavailable("Timed out reading the media header")
+    except OSError as e:
+        raise ProbeUnavailable(f"Could not run ffprobe: {e}")
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "ffprobe failed"
+        if any(marker in result.stderr for marker in UNPARSEABLE_MARKERS):
+            raise ProbeError(message)
+        raise ProbeUnavailable(message)
+
+    try:
+        data = json.loads(result.stdout or "{}")
+    except ValueError:
+        raise ProbeUnavailable("Unreadable ffprobe output")
+    fmt = data.get("format", {})
+    streams = data.get("streams", [])
+    # Cover art shows up as a video stream, skip it
+    video = next((s for s in streams if s.get("codec_type") == "video"
+                  and not s.get("disposition", {}).get("attached_pic")), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if not video:
+        raise ProbeError("No video stream found")
+
+    duration = _float(fmt.get("duration")) or _float(video.get("duration"))
+    width, height = int(video.get("width") or 0), int(video.get("height") or 0)
+    if not duration or not width or not height:
+        raise ProbeError("Video has no duration or resolution")
+
+    return {
+        "duration": round(duration, 3),
+        "width": width,
+        "height": height,
+        "video_codec": video.get("codec_name", "unknown"),
+        "audio_codec": audio.get("codec_name") if audio else None,
+        "bitrate": int(_float(fmt.get("bit_rate")) or 0),
+        "frame_rate": round(_rate(video.get("avg_frame_rate")) or _rate(video.get("r_frame_rate")) or 0.0, 3),
+        "container": fmt.get("format_name", "unknown"),
+    }
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _rate(value):
+    # ffprobe frame rates are fractions like "30000/1001"
+    try:
+        num, _, den = str(value).partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
@@ -0,0 +1,125 @@
+import os, time, math, threading, subprocess
+from datetime import datetime
+
+# Minimum seconds between DynamoDB progress writes for one job
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "5"))
+# ...unless the job moved at least this many percent since the last write
+PROGRESS_MIN_STEP = 1.0
+
+
+class ProgressReporter:
+    """Folds ffmpeg's machine-readable -progress output into one progress record per job.
+
+    Every ffmpeg of the job is launched through launch(); each gets its own pipe for
+    -progress key=value blocks. Passes may run one after another or side by side
+    (piped mode); overall percent is the average of the per-pass fractions. The
+    record is written to JOBS_TABLE at most every PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, dynamodb, table, key, duration, passes=1):
+        self.dynamodb = dynamodb
+        self.table = table
+        self.key = key
+        self.duration = duration or 0.0
+        self.passes = passes
+        self.fractions = [0.0] * passes
+        self.latest = {}
+        self.last_write = 0.0
+        self.last_percent = -PROGRESS_MIN_STEP
+        self.lock = threading.Lock()
+
+    def launch(self, cmd, pass_index=0, **popen_kwargs):
+        """Start cmd (an ffmpeg argv) with -progress wired to a reader thread."""
+        read_fd, write_fd = os.pipe()
+        cmd = [cmd[0], "-progress", f"pipe:{write_fd}", "-nostats", *cmd[1:]]
+        try:
+            proc = subprocess.Popen(cmd, pass_fds=(write_fd,), **popen_kwargs)
+        except Exception:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        threading.Thread(target=self._read, args=(read_fd, pass_index), daemon=True).start()
+        return proc
+
+    def _read(self, fd, pass_index):
+        block = {}
+        with os.fdopen(fd, "r", errors="replace") as stream:
+            for line in stream:
+                key, _, value = line.strip().partition("=")
+                if key != "progress":
+                    block[key] = value
+                    continue
+                self._update(pass_index, block, final=value == "end")
+                block = {}
+
+    def _update(self, pass_index, block, final=False):
+        try:
+            out_seconds = int(block.get("out_time_us") or block.get("out_time_ms") or 0) / 1_000_000
+        except ValueError:
+            out_seconds = 0.0
+        speed = _number(block.get("speed", "").rstrip("x"))
+
+        with self.lock:
+            if final:
+                fraction = 1.0
+            elif self.duration:
+                fraction = min(out_seconds / self.duration, 1.0)
+            else:
+                fraction = self.fractions[pass_index]
+            self.fractions[pass_index] = fraction
+            percent = round(100.0 * sum(self.fractions) / self.passes, 1)
+
+            # ETA: media time still to encode across all passes, at the current speed
+            eta = None
+            if self.duration and speed:
+                remaining = sum(1.0 - f for f in self.fractions) * self.duration
+                eta = int(remaining / speed)
+
+            self.latest = {
+                "pass": pass_index + 1,
+                "passes": self.passes,
+                "frame": int(_number(block.get("frame")) or 0),
+                "fps": _number(block.get("fps")),
+                "speed": speed,
+                "percent": percent,
+                "eta_seconds": eta,
+            }
+
+            now = time.monotonic()
+            moved = percent - self.last_percent >= PROGRESS_MIN_STEP or not self.duration
+            due = now - self.last_write >= PROGRESS_INTERVAL and moved
+            if not (due or (final and percent >= 100.0)):
+                return
+            self.last_write, self.last_percent = now, percent
+            record = dict(self.latest)
+
+        self._write(record)
+
+    def _write(self, record):
+        value = {k: _ddb_value(v) for k, v in record.items()}
+        value["updated"] = {"S": datetime.utcnow().isoformat()}
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table,
+                Key=self.key,
+                UpdateExpression="SET progress=:p",
+                # Never resurrect a job that was deleted mid-transcode
+                ConditionExpression="attribute_exists(jobs_id)",
+                ExpressionAttributeValues={":p": {"M": value}},
+            )
+        except Exception as e:
+            print(f"[PROGRESS] Write failed: {e}")
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+def _ddb_value(value):
+    if value is None:
+        return {"NULL": True}
+    return {"N": str(value)}
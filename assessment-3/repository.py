@@ -0,0 +1,111 @@
+import asyncio, functools, random
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# boto3 is blocking, so every AWS call runs on this pool. It is sized to the
+# clients' HTTP connection pools (config.MAX_POOL_CONNECTIONS): a request never
+# waits on a thread that is itself waiting for a connection, and the event
+# loop only ever awaits.
+_executor = ThreadPoolExecutor(max_workers=config.MAX_POOL_CONNECTIONS, thread_name_prefix="aws-io")
+
+BATCH_GET_RETRIES = 5
+
+# Client attributes that do no I/O and are used as-is
+_LOCAL_ATTRIBUTES = {"exceptions", "meta", "generate_presigned_url", "generate_presigned_post", "get_paginator"}
+
+
+async def run(fn, *args, **kwargs):
+    """Run a blocking call on the AWS I/O pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def gather_limited(calls, limit):
+    """Await coroutines with at most limit in flight; results (or raised exceptions) in order."""
+    sem = asyncio.Semaphore(limit)
+
+    async def bounded(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(bounded(c) for c in calls), return_exceptions=True)
+
+
+class AsyncClient:
+    """Awaitable view of a shared boto3 client: `await s3.head_object(...)`."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def __getattr__(self, name):
+        attr = getattr(config.client(self.service), name)
+        if name in _LOCAL_ATTRIBUTES:
+            return attr
+
+        async def call(*args, **kwargs):
+            return await run(attr, *args, **kwargs)
+        return call
+
+
+class Table:
+    """Async access to one DynamoDB table, in low-level attribute-value form.
+
+    Keys are passed as plain strings in key_names order, e.g.
+    `await jobs_table.get(username, jobs_id)`.
+    """
+
+    def __init__(self, name, key_names):
+        self.name = name
+        self.key_names = key_names
+        self.dynamodb = AsyncClient("dynamodb")
+
+    def key(self, *values) -> dict:
+        return {k: {"S": v} for k, v in zip(self.key_names, values)}
+
+    async def get(self, *key, **kwargs):
+        """The item, or None."""
+        resp = await self.dynamodb.get_item(TableName=self.name, Key=self.key(*key), **kwargs)
+        return resp.get("Item")
+
+    async def put(self, item, **kwargs):
+        return await self.dynamodb.put_item(TableName=self.name, Item=item, **kwargs)
+
+    async def update(self, *key, **kwargs):
+        return await self.dynamodb.update_item(TableName=self.name, Key=self.key(*key), **kwargs)
+
+    async def delete(self, *key, **kwargs):
+        return await self.dynamodb.delete_item(TableName=self.name, Key=self.key(*key), **kwargs)
+
+    async def query(self, **kwargs):
+        return await self.dynamodb.query(TableName=self.name, **kwargs)
+
+    async def batch_get(self, keys, **kwargs) -> list:
+        """Items for a list of key tuples via BatchGetItem (100 keys per call, chunks in parallel).
+
+        Missing items are simply absent from the result; unprocessed keys are retried.
+        """
+        async def chunk(chunk_keys):
+            request = {self.name: {"Keys": [self.key(*k) for k in chunk_keys], **kwargs}}
+            items = []
+            for attempt in range(BATCH_GET_RETRIES):
+                resp = await self.dynamodb.batch_get_item(RequestItems=request)
+                items += resp.get("Responses", {}).get(self.name, [])
+                request = resp.get("UnprocessedKeys") or {}
+                if not request:
+                    return items
+                await asyncio.sleep(min(1.0, 0.05 * 2 ** attempt) * random.random())
+            raise RuntimeError(f"BatchGetItem left {len(request[self.name]['Keys'])} key(s) unprocessed")
+
+        unique = list(dict.fromkeys(tuple(k) for k in keys))
+        chunks = [unique[i:i + 100] for i in range(0, len(unique), 100)]
+        return [item for items in await asyncio.gather(*(chunk(c) for c in chunks)) for item in items]
+
+    async def query_all(self, **kwargs) -> list:
+        """Items from every page of a query."""
+        items = []
+        while True:
+            resp = await self.query(**kwargs)
+            items += resp.get("Items", [])
+            if "LastEvaluatedKey" not in resp:
+                return items
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
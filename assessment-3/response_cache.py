@@ -0,0 +1,85 @@
+import time, json, hashlib, threading
+from collections import OrderedDict
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+RESPONSE_TTL = 10                      # seconds a cached response stays fresh
+RESPONSE_CACHE_ENTRIES = 2048
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class ResponseCache:
+    """Per-user cache of JSON GET responses with ETag / If-None-Match support.
+
+    Entries are keyed by user + path + query string and tagged with the job
+    owners they cover ("*" for admin views over everyone). invalidate(owner)
+    drops every entry that could include that owner's data. Bounded by entry
+    count and total body bytes, least recently used evicted first.
+    """
+
+    def __init__(self, ttl=RESPONSE_TTL, max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # key -> (expires, etag, body, scopes)
+        self.size = 0
+        self.generation = 0            # bumped by every invalidation
+        self.lock = threading.Lock()
+
+    async def respond(self, request: Request, username: str, build, scopes=None) -> Response:
+        """Serve the JSON of `await build()` for this user and URL, from cache while fresh.
+
+        Returns 304 with no body when the client's If-None-Match already has it.
+        """
+        key = (username, request.url.path, tuple(sorted(request.query_params.multi_items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] <= now:
+                self._drop(key)
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+            generation = self.generation
+
+        if entry:
+            _, etag, body, _ = entry
+        else:
+            body = json.dumps(jsonable_encoder(await build()), separators=(",", ":")).encode("utf-8")
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            with self.lock:
+                # Skip storing if a write invalidated things while we were building
+                if generation == self.generation and len(body) <= self.max_bytes:
+                    self._drop(key)
+                    self.entries[key] = (now + self.ttl, etag, body, frozenset(scopes or (username,)))
+                    self.size += len(body)
+                    while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                        self._drop(next(iter(self.entries)))
+
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def invalidate(self, owner: str):
+        """Forget every response that may include owner's data."""
+        with self.lock:
+            self.generation += 1
+            for key in [k for k, e in self.entries.items() if owner in e[3] or "*" in e[3]]:
+                self._drop(key)
+
+    def _drop(self, key):
+        # Caller holds self.lock
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry[2])
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+response_cache = ResponseCache()
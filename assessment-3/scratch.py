@@ -0,0 +1,160 @@
+import os, shutil, hashlib, threading
+from collections import OrderedDict
+
+
+class ScratchArea:
+    """Worker scratch disk with a byte quota.
+
+    root/jobs/<pid>-<id>/  per-job temp directories, always removed by cleanup_job()
+    root/cache/      downloaded sources keyed by S3 key + ETag, evicted least
+                     recently used first when a download or job needs space
+
+    Cached sources are pinned while a job uses them so they are never evicted
+    underneath a running ffmpeg. Several worker processes may share a root:
+    leftovers are only cleared when the process that made them is gone.
+    """
+
+    def __init__(self, root, quota_bytes):
+        self.root = root
+        self.quota = quota_bytes
+        self.jobs_root = os.path.join(root, "jobs")
+        self.cache_root = os.path.join(root, "cache")
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # cache file name -> size, least recently used first
+        self.pins = {}                # cache file name -> set of job dirs using it
+        self.reserved = {}            # .part path -> bytes promised to a download in progress
+        self._load()
+
+    def _load(self):
+        # Job dirs and partial downloads left by a dead worker are garbage; cached sources are reusable
+        os.makedirs(self.jobs_root, exist_ok=True)
+        os.makedirs(self.cache_root, exist_ok=True)
+        for name in os.listdir(self.jobs_root):
+            if not _owner_alive(name):
+                shutil.rmtree(os.path.join(self.jobs_root, name), ignore_errors=True)
+        files = []
+        for name in os.listdir(self.cache_root):
+            path = os.path.join(self.cache_root, name)
+            if name.endswith(".part"):
+                if not _owner_alive(name.rsplit(".", 2)[-2]):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+
+    # ---------------- JOB DIRS ----------------
+    def job_dir(self, name):
+        """A new temp dir for one job run; name must be unique to this run."""
+        path = os.path.join(self.jobs_root, f"{os.getpid()}-{name}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def cleanup_job(self, path):
+        """Remove a job's temp files and release the cached sources it pinned."""
+        shutil.rmtree(path, ignore_errors=True)
+        with self.lock:
+            for name in [n for n, users in self.pins.items() if path in users]:
+                self.pins[name].discard(path)
+                if not self.pins[name]:
+                    del self.pins[name]
+
+    # ---------------- SOURCE CACHE ----------------
+    def cached_source(self, s3, bucket, key, job_path):
+        """Local path of s3://bucket/key, downloading it only if this version isn't cached.
+
+        Returns (path, bytes downloaded). The file is pinned to job_path until
+        cleanup_job(job_path). Sources larger than the whole quota are downloaded
+        into the job dir instead of the cache.
+        """
+        head = s3.head_object(Bucket=bucket, Key=key)
+        size = head["ContentLength"]
+        digest = hashlib.sha256(f"{key}|{head['ETag']}".encode("utf-8")).hexdigest()[:32]
+        name = digest + os.path.splitext(key)[1]
+        path = os.path.join(self.cache_root, name)
+
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.pins.setdefault(name, set()).add(job_path)
+                os.utime(path)
+                print(f"[SCRATCH] Cache hit for {key}")
+                return path, 0
+            cacheable = size <= self.quota
+            part = f"{path}.{os.getpid()}-{threading.get_ident()}.part"
+            if cacheable:
+                self._make_room(size)
+                # Pin before downloading so a concurrent job can't evict our reservation, and
+                # count the bytes until they land in entries so concurrent downloads can't overrun the quota
+                self.pins.setdefault(name, set()).add(job_path)
+                self.reserved[part] = size
+
+        if not cacheable:
+            local = os.path.join(job_path, os.path.basename(key))
+            s3.download_file(bucket, key, local)
+            return local, size
+
+        try:
+            s3.download_file(bucket, key, part)
+            os.replace(part, path)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            with self.lock:
+                self.reserved.pop(part, None)
+                self.pins.get(name, set()).discard(job_path)
+            raise
+        with self.lock:
+            self.reserved.pop(part, None)
+            self.entries[name] = size
+            self.entries.move_to_end(name)
+        return path, size
+
+    def _make_room(self, needed):
+        # Caller holds self.lock
+        used = sum(self.entries.values()) + sum(self.reserved.values()) + self._jobs_usage()
+        for name in list(self.entries):
+            if used + needed <= self.quota:
+                break
+            if self.pins.get(name):
+                continue
+            size = self.entries.pop(name)
+            try:
+                os.remove(os.path.join(self.cache_root, name))
+            except FileNotFoundError:
+                pass
+            used -= size
+            print(f"[SCRATCH] Evicted {name} ({size} bytes)")
+        if used + needed > self.quota:
+            print(f"[SCRATCH] Over quota: {used + needed} of {self.quota} bytes (everything left is in use)")
+
+    def _jobs_usage(self):
+        total = 0
+        for root, _, names in os.walk(self.jobs_root):
+            for name in names:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+
+def _owner_alive(name):
+    """Whether the process whose pid starts name ("<pid>-...") is still running."""
+    try:
+        pid = int(name.split("-", 1)[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -1,136 +1,1147 @@
-import boto3, json, time, os, subprocess, traceback
+import boto3, json, time, os, subprocess, traceback, socket, threading, shutil, hashlib, uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from progress import ProgressReporter
+from scratch import ScratchArea
+from probe import probe_media, ProbeError, ProbeUnavailable
+from urllib.parse import unquote_plus
+import jobrecords
+import metrics
 
 # ---------------- CONFIG ----------------
 REGION = "ap-southeast-2"
 SQS_QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n10893997-sqs-a3"
+# Size-class queues filled by /jobs/start; "medium" is the original queue
+SQS_QUEUES = {
+    "small": "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n10893997-sqs-a3-small",
+    "medium": SQS_QUEUE_URL,
+    "large": "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n10893997-sqs-a3-large",
+}
 S3_BUCKET = "n10893997-videos"
 JOBS_TABLE = "n10893997-a2-jobs3"
+UPLOADS_TABLE = "n10893997-a2"
+CACHE_TABLE = "n10893997-a3-transcode-cache"
+
+# Number of jobs run at the same time on this instance (1 = one job at a time)
+WORKER_SLOTS = max(1, int(os.getenv("WORKER_SLOTS", "1")))
+SQS_MAX_BATCH = 10  # SQS hard limit for MaxNumberOfMessages
+SQS_WAIT_SECONDS = 10  # long poll, used on the last queue of each polling cycle
+
+# Weighted polling of the size classes; a class not polled for
+# STARVATION_SECONDS jumps the line so big jobs always make progress
+QUEUE_WEIGHTS = {"small": 6, "medium": 3, "large": 1}
+STARVATION_SECONDS = int(os.getenv("STARVATION_SECONDS", "120"))
+
+# In-flight messages are kept invisible by a heartbeat that re-extends them
+# well before they would time out (the queue default is only 60s)
+VISIBILITY_TIMEOUT = int(os.getenv("VISIBILITY_TIMEOUT", "180"))
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+# Split the cores between slots so parallel ffmpeg runs don't fight each other
+FFMPEG_THREADS = os.getenv("FFMPEG_THREADS") or (
+    "0" if WORKER_SLOTS == 1 else str(max(1, (os.cpu_count() or 1) // WORKER_SLOTS))
+)
+
+# Encoder settings (see benchmark.py for measuring alternatives)
+FFMPEG_PRESET = os.getenv("FFMPEG_PRESET", "slow")
+FFMPEG_CRF = os.getenv("FFMPEG_CRF", "18")
+
+# How the 3 transcode passes are chained: "pipe" (default), "files" or "single"
+TRANSCODE_MODE = os.getenv("TRANSCODE_MODE", "pipe")
+
+# "stream": ffmpeg reads the source from a presigned S3 URL (ranged HTTP reads)
+# "download": copy the whole source to the scratch cache first (the source cache is only used in this mode)
+INPUT_MODE = os.getenv("INPUT_MODE", "stream")
+STREAM_URL_EXPIRY = 6 * 3600  # must outlive the longest transcode
+
+# "stream": fragmented MP4 is multipart-uploaded while ffmpeg is still encoding
+# "file": write the whole output to scratch, then upload_file
+OUTPUT_MODE = os.getenv("OUTPUT_MODE", "stream")
+UPLOAD_PART_SIZE = 16 * 1024 * 1024  # S3 minimum is 5 MB for all but the last part
+UPLOAD_CONCURRENCY = 4
+
+# Adaptive bitrate ladder for "hls" jobs: (name, height, video bitrate, audio bitrate)
+ABR_LADDER = [
+    ("1080p", 1080, 5000, 192),
+    ("720p", 720, 2800, 128),
+    ("480p", 480, 1400, 128),
+    ("360p", 360, 800, 96),
+]
+HLS_SEGMENT_SECONDS = 6
+
+# Split/encode/concat: long sources are cut into keyframe-aligned segments that
+# any worker can encode, and the worker finishing the last segment stitches them
+SEGMENTED_MODE = os.getenv("SEGMENTED_MODE", "0") == "1"
+SEGMENT_SECONDS = int(os.getenv("SEGMENT_SECONDS", "60"))
+SEGMENT_MIN_DURATION = int(os.getenv("SEGMENT_MIN_DURATION", "300"))  # shorter jobs run whole
+
+# Reuse the output of an earlier job with the same source content and encode settings
+RESULT_CACHE = os.getenv("RESULT_CACHE", "1") == "1"
+
+# Local scratch disk: per-job temp dirs plus an LRU cache of downloaded sources
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", "/tmp/transcoder")
+SCRATCH_QUOTA_BYTES = int(float(os.getenv("SCRATCH_QUOTA_GB", "4")) * 1024 ** 3)
+
+# Prometheus-style /metrics endpoint inside the worker (0 = disabled)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
 
 # ---------------- AWS CLIENTS ----------------
-sqs = boto3.client("sqs", region_name=REGION)
-s3 = boto3.client("s3", region_name=REGION)
-dynamodb = boto3.client("dynamodb", region_name=REGION)
+sqs = metrics.instrument_client(boto3.client("sqs", region_name=REGION))
+s3 = metrics.instrument_client(boto3.client("s3", region_name=REGION))
+dynamodb = metrics.instrument_client(boto3.client("dynamodb", region_name=REGION))
+
+# Built in main(): creating it clears dead workers' leftovers, which importing must not do
+scratch = None
+
+# ---------------- METRICS ----------------
+STAGE_SECONDS = metrics.histogram("worker_stage_seconds", "Wall time per job stage")
+FFMPEG_PASS_SECONDS = metrics.histogram("worker_ffmpeg_pass_seconds", "Wall time per ffmpeg process, by pass")
+QUEUE_WAIT_SECONDS = metrics.histogram("worker_queue_wait_seconds", "Time from SQS SentTimestamp to pickup")
+ENCODE_FPS = metrics.histogram("worker_encode_fps", "Final ffmpeg encode speed in frames per second",
+                               buckets=(1, 2, 5, 10, 15, 24, 30, 60, 120, 240, 480))
+BYTES_MOVED = metrics.counter("worker_bytes_total", "Bytes moved between the worker and S3")
+JOBS_TOTAL = metrics.counter("worker_messages_total", "Messages handled, by outcome")
+
+# ---------------- IN-FLIGHT TRACKING ----------------
+# Delivery id (one per received copy; a redelivered message gets its own) ->
+# {"receipt": ReceiptHandle, "queue": QueueUrl, "job": (user, job_id) and "token": claim token once claimed}
+in_flight_msgs = {}
+in_flight_lock = threading.Lock()
+
+def _job_key(user, job_id):
+    return {"qut-username": {"S": user}, "jobs_id": {"S": job_id}}
+
+def heartbeat_loop():
+    """Keep extending SQS visibility and DynamoDB leases for every in-flight job."""
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        with in_flight_lock:
+            entries = [(did, dict(e)) for did, e in in_flight_msgs.items()]
+        if not entries:
+            continue
+
+        # SQS visibility, 10 messages per call and queue
+        by_queue = {}
+        for did, e in entries:
+            by_queue.setdefault(e["queue"], []).append((did, e))
+        for queue_url, queue_entries in by_queue.items():
+            for i in range(0, len(queue_entries), SQS_MAX_BATCH):
+                batch = queue_entries[i:i + SQS_MAX_BATCH]
+                try:
+                    resp = sqs.change_message_visibility_batch(
+                        QueueUrl=queue_url,
+                        Entries=[
+                            {"Id": did, "ReceiptHandle": e["receipt"], "VisibilityTimeout": VISIBILITY_TIMEOUT}
+                            for did, e in batch
+                        ],
+                    )
+                    for failed in resp.get("Failed", []):
+                        print(f"[HEARTBEAT] Could not extend {failed['Id']}: {failed.get('Message')}")
+                except Exception as e:
+                    print(f"[HEARTBEAT] Visibility extension failed: {e}")
+
+        # DynamoDB leases, only renewed while we still own the claim
+        lease_until = int(time.time()) + VISIBILITY_TIMEOUT
+        for did, e in entries:
+            if not e.get("job"):
+                continue
+            try:
+                dynamodb.update_item(
+                    TableName=JOBS_TABLE,
+                    Key=_job_key(*e["job"]),
+                    UpdateExpression="SET lease_until=:l",
+                    ConditionExpression="claimed_by = :w",
+                    ExpressionAttributeValues={":l": {"N": str(lease_until)}, ":w": {"S": e["token"]}},
+                )
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                print(f"[HEARTBEAT] Lost claim on job {e['job'][1]}")
+            except Exception as ex:
+                print(f"[HEARTBEAT] Lease renewal failed for job {e['job'][1]}: {ex}")
+
+# ---------------- JOB CLAIM ----------------
+def new_claim_token():
+    """Identifies one claim: unique per delivery, so two slots of one worker never share a lease."""
+    return f"{WORKER_ID}-{uuid.uuid4().hex}"
+
+def claim_job(user, job_id, token):
+    """Atomically mark a job as 'processing' under this claim token.
+
+    Returns False if the job is gone, already completed, already split into
+    segments, or leased by any other claim (including another slot of this
+    worker) - i.e. this delivery is a duplicate and should be dropped.
+    """
+    now = int(time.time())
+    try:
+        dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key=_job_key(user, job_id),
+            UpdateExpression="SET #s=:s, started=:t, claimed_by=:w, lease_until=:l",
+            ConditionExpression=(
+                "attribute_exists(jobs_id) AND #s <> :done AND attribute_not_exists(segments_total) AND "
+                "(attribute_not_exists(lease_until) OR lease_until < :now)"
+            ),
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={
+                ":s": {"S": "processing"},
+                ":t": {"S": datetime.utcnow().isoformat()},
+                ":w": {"S": token},
+                ":l": {"N": str(now + VISIBILITY_TIMEOUT)},
+                ":now": {"N": str(now)},
+                ":done": {"S": "completed"},
+            },
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def release_job(user, job_id, token):
+    """Drop our lease after a failure so the SQS retry can claim the job straight away."""
+    try:
+        dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key=_job_key(user, job_id),
+            UpdateExpression="REMOVE lease_until, claimed_by",
+            ConditionExpression="claimed_by = :w",
+            ExpressionAttributeValues={":w": {"S": token}},
+        )
+    except Exception as e:
+        print(f"[WORKER] Could not release job {job_id}: {e}")
+
+def mark_completed(user, job_id, output_key, cache_key=None):
+    """Record the output on the job. False if the job was deleted or completed in the meantime."""
+    values = {
+        ":s": {"S": "completed"},
+        ":o": {"S": output_key},
+        ":f": {"S": datetime.utcnow().isoformat()},
+    }
+    update = "SET #s=:s, #out=:o, finished=:f"
+    # cache_key tells delete_job the output is shared and reference counted
+    if cache_key:
+        update += ", cache_key=:c"
+        values[":c"] = {"S": cache_key}
+    try:
+        dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key=_job_key(user, job_id),
+            UpdateExpression=update + " REMOVE lease_until, claimed_by",
+            # Never recreate a deleted job as a bare row holding a reference on the output
+            ConditionExpression="attribute_exists(jobs_id) AND #s <> :s",
+            ExpressionAttributeNames={"#s": "status", "#out": "output"},
+            ExpressionAttributeValues=values,
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def finish_job(user, job_id, output_key, cache_key=None):
+    """mark_completed, giving the output back (reference or object) when the job can't take it."""
+    try:
+        done = mark_completed(user, job_id, output_key, cache_key)
+    except Exception:
+        # Outcome unknown: keep the output only if the write landed, so a retry can't count it twice
+        item = dynamodb.get_item(TableName=JOBS_TABLE, Key=_job_key(user, job_id), ConsistentRead=True).get("Item", {})
+        if item.get("output", {}).get("S") != output_key:
+            discard_output(output_key, cache_key)
+        raise
+    if not done:
+        print(f"[WORKER] Job {job_id} was deleted or already completed - releasing its output.")
+        discard_output(output_key, cache_key)
+    return done
+
+def discard_output(output_key, cache_key=None):
+    """Drop one reference on a cached output (deleting it at zero), or delete a private output."""
+    if cache_key:
+        try:
+            resp = dynamodb.update_item(
+                TableName=CACHE_TABLE,
+                Key={"cache_key": {"S": cache_key}},
+                UpdateExpression="ADD refcount :neg",
+                ConditionExpression="attribute_exists(cache_key)",
+                ExpressionAttributeValues={":neg": {"N": "-1"}},
+                ReturnValues="UPDATED_NEW",
+            )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            resp = None  # entry already gone, nothing else shares the object
+        if resp and int(resp["Attributes"]["refcount"]["N"]) > 0:
+            return
+        if resp:
+            # refcount 0 blocks new cache hits, so the entry and object can go
+            dynamodb.delete_item(TableName=CACHE_TABLE, Key={"cache_key": {"S": cache_key}})
+    if output_key.endswith(".m3u8"):
+        delete_prefix(output_key.rsplit("/", 1)[0])  # HLS: the whole rendition directory
+    else:
+        s3.delete_object(Bucket=S3_BUCKET, Key=output_key)
+
+# ---------------- RESULT CACHE ----------------
+def encode_signature(output_format):
+    """Everything that changes the bytes of the output for a given source."""
+    if output_format == "hls":
+        return {"format": "hls", "filter": ENHANCE_FILTER, "ladder": ABR_LADDER, "segment": HLS_SEGMENT_SECONDS,
+                "preset": FFMPEG_PRESET}
+    # "pipe" and "files" give the same result, "single" skips the intermediate encodes
+    chain = "single" if TRANSCODE_MODE == "single" else "passes"
+    # Streamed outputs are fragmented MP4; split jobs are stitched from separately encoded segments
+    segmented = [SEGMENT_SECONDS, SEGMENT_MIN_DURATION] if SEGMENTED_MODE else None
+    return {"format": "mp4", "filter": VIDEO_FILTER, "passes": TRANSCODE_PASSES, "chain": chain,
+            "encode": encode_args(threads="any"), "container": OUTPUT_MODE, "segmented": segmented}
+
+def result_cache_key(s3_key, output_format):
+    """Hash of the source content (S3 ETag + size, no full read needed) and the encode settings."""
+    head = s3.head_object(Bucket=S3_BUCKET, Key=s3_key)
+    source = f"{head['ETag'].strip(chr(34))}:{head['ContentLength']}"
+    params = json.dumps(encode_signature(output_format), sort_keys=True)
+    return hashlib.sha256(f"{source}|{params}".encode("utf-8")).hexdigest()
+
+def acquire_cached_output(cache_key):
+    """Take a reference on a cached output. Returns its S3 key, or None on a miss."""
+    try:
+        resp = dynamodb.update_item(
+            TableName=CACHE_TABLE,
+            Key={"cache_key": {"S": cache_key}},
+            UpdateExpression="ADD refcount :one",
+            # refcount 0 means delete_job is removing the object right now
+            ConditionExpression="attribute_exists(cache_key) AND refcount > :zero",
+            ExpressionAttributeValues={":one": {"N": "1"}, ":zero": {"N": "0"}},
+            ReturnValues="ALL_NEW",
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
+    return resp["Attributes"]["output"]["S"]
+
+def store_cached_output(cache_key, output_key):
+    """Register a fresh output with one reference. False if an identical job got there first."""
+    try:
+        dynamodb.put_item(
+            TableName=CACHE_TABLE,
+            Item={
+                "cache_key": {"S": cache_key},
+                "output": {"S": output_key},
+                "refcount": {"N": "1"},
+                "created": {"S": datetime.utcnow().isoformat()},
+            },
+            ConditionExpression="attribute_not_exists(cache_key)",
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def complete_with_cache(user, job_id, output_key, cache_key):
+    """Mark a freshly transcoded job completed, publishing its output to the cache if enabled."""
+    if cache_key and not store_cached_output(cache_key, output_key):
+        cache_key = None  # keep this output private to the job
+    return finish_job(user, job_id, output_key, cache_key)
 
 # ---------------- FFMPEG RUNNER ----------------
-def run_ffmpeg(input_path, output_path):
+ENHANCE_FILTER = "eq=contrast=1.8:brightness=0.08:saturation=1.8,unsharp=5:5:1.0"
+VIDEO_FILTER = f"scale=1920:1080,{ENHANCE_FILTER}"
+TRANSCODE_PASSES = int(os.getenv("TRANSCODE_PASSES", "3"))
+
+def encode_args(threads=None):
+    return [
+        "-c:v", "libx264",
+        "-preset", FFMPEG_PRESET,
+        "-crf", FFMPEG_CRF,
+        "-threads", threads or FFMPEG_THREADS,
+        "-c:a", "aac",
+        "-b:a", "256k",
+    ]
+
+def input_args(input_path):
+    """ffmpeg input options; URLs get reconnects so a dropped S3 connection resumes with a range read."""
+    if input_path.startswith(("http://", "https://")):
+        return [
+            "-reconnect", "1",
+            "-reconnect_on_network_error", "1",
+            "-reconnect_delay_max", "5",
+            "-i", input_path,
+        ]
+    return ["-i", input_path]
+
+def output_args(output_path, upload_key=None):
+    """ffmpeg output options; when streaming to S3 the output is fragmented MP4 on stdout."""
+    if upload_key:
+        return ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof", "pipe:1"]
+    return [output_path]
+
+def launch(cmd, progress=None, pass_index=0, **popen_kwargs):
+    """Popen an ffmpeg command, reporting its progress if the job has a reporter."""
+    if progress:
+        proc = progress.launch(cmd, pass_index, **popen_kwargs)
+    else:
+        proc = subprocess.Popen(cmd, **popen_kwargs)
+    proc.pass_index, proc.started = pass_index, time.monotonic()
+    return proc
+
+def run_ffmpeg(input_path, output_path, mode=None, upload_key=None, progress=None):
+    """Run the multi-pass transcode.
+
+    mode "files":  each pass writes a full MP4 next to output_path and the next pass reads it
+    mode "pipe":   passes run side by side, streaming NUT from one ffmpeg's stdout to the next's stdin
+    mode "single": the filter chain is repeated in one filter graph and encoded once
+
+    input_path may be a local file or a presigned S3 URL. If upload_key is given the
+    final output is multipart-uploaded to S3 while encoding and never written to
+    output_path (which is then only used to name intermediates). progress is an
+    optional ProgressReporter with one slot per pass (a single slot for "single").
+    """
+    mode = mode or TRANSCODE_MODE
+    if mode == "single":
+        print(f"[WORKER] Single pass ({TRANSCODE_PASSES}x filter graph) → {upload_key or output_path}")
+        cmd = [
+            "ffmpeg", "-y", "-nostdin", *input_args(input_path),
+            "-vf", ",".join([VIDEO_FILTER] * TRANSCODE_PASSES),
+            *encode_args(),
+            *output_args(output_path, upload_key),
+        ]
+        finish_ffmpeg([launch(cmd, progress, stdout=subprocess.PIPE if upload_key else None)], upload_key)
+    elif mode == "pipe":
+        run_ffmpeg_piped(input_path, output_path, upload_key, progress)
+    else:
+        run_ffmpeg_files(input_path, output_path, upload_key, progress)
+
+def run_ffmpeg_files(input_path, output_path, upload_key=None, progress=None):
     # 3 passes to simulate heavy transcoding (for demo load)
-    for i in range(3):
-        temp_output = f"/tmp/loop_{i}.mp4"
-        print(f"[WORKER] Pass {i+1}/3 - transcoding {input_path} → {temp_output}")
+    for i in range(TRANSCODE_PASSES):
+        last = i == TRANSCODE_PASSES - 1
+        temp_output = f"{output_path}.pass{i}.mp4"
+        print(f"[WORKER] Pass {i+1}/{TRANSCODE_PASSES} - transcoding → {upload_key if last and upload_key else temp_output}")
+
+        cmd = [
+            "ffmpeg", "-y", "-nostdin", *input_args(input_path),
+            "-vf", VIDEO_FILTER,
+            *encode_args(),
+            *output_args(temp_output, upload_key if last else None),
+        ]
+        if last and upload_key:
+            finish_ffmpeg([launch(cmd, progress, i, stdout=subprocess.PIPE)], upload_key)
+        else:
+            finish_ffmpeg([launch(cmd, progress, i)])
+
+        # Intermediate passes are only read once
+        if i > 0:
+            os.remove(input_path)
+        input_path = temp_output
+
+    if not upload_key:
+        os.rename(temp_output, output_path)
+
+def run_ffmpeg_piped(input_path, output_path, upload_key=None, progress=None):
+    # Same passes, but chained through pipes so nothing but the final output touches disk
+    procs = []
+    upstream = None
+    for i in range(TRANSCODE_PASSES):
+        last = i == TRANSCODE_PASSES - 1
+        cmd = ["ffmpeg", "-y", "-hide_banner"]
+        cmd += ["-nostdin", *input_args(input_path)] if i == 0 else ["-f", "nut", "-i", "pipe:0"]
+        cmd += ["-vf", VIDEO_FILTER, *encode_args()]
+        cmd += output_args(output_path, upload_key) if last else ["-f", "nut", "pipe:1"]
+        print(f"[WORKER] Pass {i+1}/{TRANSCODE_PASSES} (piped) → {(upload_key or output_path) if last else 'pipe'}")
+
+        proc = launch(
+            cmd, progress, i,
+            stdin=upstream if upstream else subprocess.DEVNULL,
+            stdout=None if last and not upload_key else subprocess.PIPE,
+        )
+        # Parent drops its copy so the upstream ffmpeg sees EPIPE if this one dies
+        if upstream:
+            upstream.close()
+        upstream = proc.stdout
+        procs.append(proc)
+
+    finish_ffmpeg(procs, upload_key)
+
+def finish_ffmpeg(procs, upload_key=None):
+    """Wait for a chain of ffmpeg processes, streaming the last one's stdout to S3 if asked."""
+    try:
+        if upload_key:
+            upload_stream(procs[-1].stdout, upload_key, procs)
+        check_procs(procs)
+    except Exception:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+        raise
+
+def check_procs(procs):
+    codes = []
+    for proc in procs:
+        codes.append(proc.wait())
+        if getattr(proc, "started", None) is not None:
+            FFMPEG_PASS_SECONDS.observe(time.monotonic() - proc.started, **{"pass": proc.pass_index + 1})
+            proc.started = None
+    for proc, code in zip(procs, codes):
+        if code != 0:
+            raise subprocess.CalledProcessError(code, proc.args)
+
+# ---------------- STREAMING UPLOAD ----------------
+def _read_part(stream, size):
+    # Pipes return short reads, keep going until the part is full or EOF
+    chunks, remaining = [], size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+def upload_stream(stream, key, procs=()):
+    """Multipart-upload a stream to S3 while it is still being produced.
+
+    Parts are uploaded in parallel (at most UPLOAD_CONCURRENCY in memory at once).
+    The upload is only completed if every process in procs exits cleanly;
+    otherwise it is aborted so no partial object is left behind.
+    """
+    upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=key, ContentType="video/mp4")["UploadId"]
+    slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+    pool = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="upload")
+    futures = []
+
+    def put_part(number, data):
+        try:
+            resp = s3.upload_part(Bucket=S3_BUCKET, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+            BYTES_MOVED.inc(len(data), direction="upload")
+            return {"PartNumber": number, "ETag": resp["ETag"]}
+        finally:
+            slots.release()
+
+    try:
+        number = 0
+        while True:
+            data = _read_part(stream, UPLOAD_PART_SIZE)
+            if not data:
+                break
+            number += 1
+            slots.acquire()
+            failed = [f for f in futures if f.done() and f.exception()]
+            if failed:
+                slots.release()
+                raise failed[0].exception()
+            futures.append(pool.submit(put_part, number, data))
+
+        parts = [f.result() for f in futures]
+        check_procs(procs)
+        if not parts:
+            raise RuntimeError(f"ffmpeg produced no output for {key}")
+
+        s3.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=key, UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        print(f"[WORKER] Streamed {number} part(s) to s3://{S3_BUCKET}/{key}")
+    except Exception:
+        s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        pool.shutdown(wait=True)
 
+# ---------------- SOURCE INPUT ----------------
+def source_input(s3_key, work_dir):
+    """Presigned URL for ffmpeg to stream from, or a local copy from the scratch cache."""
+    if INPUT_MODE == "stream":
+        return s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": s3_key},
+            ExpiresIn=STREAM_URL_EXPIRY,
+        )
+    with STAGE_SECONDS.time(stage="download"):
+        local_path, downloaded = scratch.cached_source(s3, S3_BUCKET, s3_key, work_dir)
+    BYTES_MOVED.inc(downloaded, direction="download")
+    return local_path
+
+def probe_duration(input_path):
+    """Source duration in seconds (0.0 if ffprobe can't tell)."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", input_path],
+        capture_output=True, text=True,
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return 0.0
+
+def has_audio(input_path):
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a", "-show_entries", "stream=index", "-of", "csv=p=0", input_path],
+        capture_output=True, text=True,
+    )
+    return bool(result.stdout.strip())
+
+# ---------------- ABR LADDER (HLS) ----------------
+HLS_CONTENT_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+
+def run_abr_ladder(input_path, user, job_id, work_dir, progress=None):
+    """Decode the source once and encode every ABR_LADDER rendition as HLS.
+
+    Returns the S3 key of the uploaded master playlist.
+    """
+    out_dir = os.path.join(work_dir, "hls")
+    prefix = f"{user}/hls/{job_id}"
+    os.makedirs(out_dir, exist_ok=True)
+    try:
+        audio = has_audio(input_path)
+        n = len(ABR_LADDER)
+
+        # One decode + enhance, split into one scaled branch per rendition
+        graph = f"[0:v]{ENHANCE_FILTER},split={n}" + "".join(f"[v{i}]" for i in range(n)) + ";"
+        graph += ";".join(f"[v{i}]scale=-2:{height}[out{i}]" for i, (_, height, _, _) in enumerate(ABR_LADDER))
+
+        cmd = ["ffmpeg", "-y", "-nostdin", *input_args(input_path), "-filter_complex", graph]
+        stream_map = []
+        for i, (name, _, v_kbps, a_kbps) in enumerate(ABR_LADDER):
+            cmd += [
+                "-map", f"[out{i}]",
+                f"-c:v:{i}", "libx264",
+                f"-b:v:{i}", f"{v_kbps}k",
+                f"-maxrate:v:{i}", f"{int(v_kbps * 1.07)}k",
+                f"-bufsize:v:{i}", f"{int(v_kbps * 1.5)}k",
+            ]
+            if audio:
+                cmd += ["-map", "0:a:0", f"-c:a:{i}", "aac", f"-b:a:{i}", f"{a_kbps}k"]
+                stream_map.append(f"v:{i},a:{i},name:{name}")
+            else:
+                stream_map.append(f"v:{i},name:{name}")
+
+        cmd += [
+            "-preset", FFMPEG_PRESET,
+            "-threads", FFMPEG_THREADS,
+            # Keyframes on segment boundaries so every rendition switches cleanly
+            "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+            "-sc_threshold", "0",
+            "-f", "hls",
+            "-hls_time", str(HLS_SEGMENT_SECONDS),
+            "-hls_playlist_type", "vod",
+            "-hls_segment_filename", os.path.join(out_dir, "%v", "seg_%05d.ts"),
+            "-master_pl_name", "master.m3u8",
+            "-var_stream_map", " ".join(stream_map),
+            os.path.join(out_dir, "%v", "index.m3u8"),
+        ]
+        print(f"[WORKER] ABR ladder ({', '.join(r[0] for r in ABR_LADDER)}) for job {job_id}")
+        with STAGE_SECONDS.time(stage="abr_ladder"):
+            finish_ffmpeg([launch(cmd, progress)])
+
+        files = []
+        for root, _, names in os.walk(out_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                files.append((path, f"{prefix}/{os.path.relpath(path, out_dir)}"))
+
+        def put(entry):
+            path, key = entry
+            content_type = HLS_CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")
+            s3.upload_file(path, S3_BUCKET, key, ExtraArgs={"ContentType": content_type})
+            BYTES_MOVED.inc(os.path.getsize(path), direction="upload")
+
+        with STAGE_SECONDS.time(stage="upload"), ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            list(pool.map(put, files))
+        print(f"[WORKER] Uploaded {len(files)} HLS file(s) to s3://{S3_BUCKET}/{prefix}/")
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return f"{prefix}/master.m3u8"
+
+# ---------------- SEGMENTED JOBS ----------------
+def segment_prefix(user, job_id):
+    return f"segments/{user}/{job_id}"
+
+def split_job(user, job_id, input_path, output_key, work_dir, cache_key=None, queue_url=SQS_QUEUE_URL):
+    """Cut the source at keyframes, upload the pieces and publish one SQS sub-job per segment.
+
+    Segments go to the queue the parent came from, so they keep its size-class priority.
+    """
+    work_dir = os.path.join(work_dir, "segments")
+    prefix = segment_prefix(user, job_id)
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        # Stream copy, so cuts land on the first keyframe after each SEGMENT_SECONDS
+        split_start = time.monotonic()
         subprocess.run([
-            "ffmpeg", "-y", "-i", input_path,
-            "-vf", "scale=1920:1080,eq=contrast=1.8:brightness=0.08:saturation=1.8,unsharp=5:5:1.0",
-            "-c:v", "libx264",
-            "-preset", "slow",
-            "-crf", "18",
-            "-threads", "0",
-            "-c:a", "aac",
-            "-b:a", "256k",
-            temp_output
+            "ffmpeg", "-y", "-nostdin", *input_args(input_path),
+            "-map", "0:v:0", "-map", "0:a?",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", str(SEGMENT_SECONDS),
+            "-reset_timestamps", "1",
+            os.path.join(work_dir, "src_%04d.mp4"),
         ], check=True)
 
-        input_path = temp_output
+        pieces = sorted(name for name in os.listdir(work_dir) if name.startswith("src_"))
+        if not pieces:
+            raise RuntimeError(f"Splitting produced no segments for job {job_id}")
+        STAGE_SECONDS.observe(time.monotonic() - split_start, stage="split")
+        for name in pieces:
+            path = os.path.join(work_dir, name)
+            with STAGE_SECONDS.time(stage="upload"):
+                s3.upload_file(path, S3_BUCKET, f"{prefix}/{name}")
+            BYTES_MOVED.inc(os.path.getsize(path), direction="upload")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-    os.rename(temp_output, output_path)
+    messages = [
+        {
+            "type": "segment",
+            "username": user,
+            "jobs_id": job_id,
+            "s3_key": f"{prefix}/{name}",
+            "segment": i,
+            "segments_total": len(pieces),
+            "output_key": output_key,
+            "cache_key": cache_key,
+        }
+        for i, name in enumerate(pieces)
+    ]
+    for i in range(0, len(messages), SQS_MAX_BATCH):
+        batch = messages[i:i + SQS_MAX_BATCH]
+        resp = sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{"Id": str(m["segment"]), "MessageBody": json.dumps(m)} for m in batch],
+        )
+        if resp.get("Failed"):
+            raise RuntimeError(f"Could not queue segments for job {job_id}: {resp['Failed']}")
 
-# ---------------- MAIN WORKER LOOP ----------------
-while True:
+    # Recording segments_total marks the split as done (see claim_job); the lease is no longer needed
+    dynamodb.update_item(
+        TableName=JOBS_TABLE,
+        Key=_job_key(user, job_id),
+        UpdateExpression="SET segments_total=:n REMOVE lease_until, claimed_by, segments_done, stitching",
+        ExpressionAttributeValues={":n": {"N": str(len(pieces))}},
+    )
+    print(f"[WORKER] Split job {job_id} into {len(pieces)} segment(s)")
+
+def handle_segment(body, work_dir):
+    """Encode one segment, record it, and stitch the job if it was the last one."""
+    required = ("username", "jobs_id", "s3_key", "segment", "segments_total", "output_key")
+    if any(body.get(k) is None for k in required):
+        raise ValueError(f"Incomplete segment message: {body}")
+    user, job_id = body["username"], body["jobs_id"]
+    seg, total = int(body["segment"]), int(body["segments_total"])
+    prefix = segment_prefix(user, job_id)
+
+    resp = dynamodb.get_item(
+        TableName=JOBS_TABLE,
+        Key=_job_key(user, job_id),
+        ProjectionExpression="#s, segments_done",
+        ExpressionAttributeNames={"#s": "status"},
+    )
+    item = resp.get("Item")
+    if not item:
+        print(f"[WORKER] Job {job_id} no longer exists - dropping segment {seg}.")
+        return
+    if item.get("status", {}).get("S") == "completed":
+        print(f"[WORKER] Job {job_id} already completed - dropping segment {seg}.")
+        return
+
+    done = set(item.get("segments_done", {}).get("NS", []))
+    if str(seg) in done:
+        print(f"[WORKER] Segment {seg} of job {job_id} already encoded - skipping.")
+    else:
+        print(f"[WORKER] Encoding segment {seg + 1}/{total} of job {job_id}")
+        input_path = source_input(body["s3_key"], work_dir)
+        with STAGE_SECONDS.time(stage="segment_transcode"):
+            run_ffmpeg(input_path, os.path.join(work_dir, f"enc_{seg:04d}.mp4"), upload_key=f"{prefix}/enc_{seg:04d}.mp4")
+
+        # Number-set ADD is idempotent, so a redelivered segment can't be counted twice
+        resp = dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key=_job_key(user, job_id),
+            UpdateExpression="ADD segments_done :seg",
+            ExpressionAttributeValues={":seg": {"NS": [str(seg)]}},
+            ReturnValues="UPDATED_NEW",
+        )
+        done = set(resp["Attributes"]["segments_done"]["NS"])
+
+    if len(done) >= total:
+        stitch_job(user, job_id, total, body["output_key"], work_dir, body.get("cache_key"))
+
+def stitch_job(user, job_id, total, output_key, work_dir, cache_key=None):
+    """Stream-copy concat the encoded segments into the final output and complete the job."""
+    # Only one worker stitches, even if the last segment was delivered twice
     try:
-        # Poll SQS for new messages
-        resp = sqs.receive_message(
-            QueueUrl=SQS_QUEUE_URL,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=10,
+        dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key=_job_key(user, job_id),
+            UpdateExpression="SET stitching=:w",
+            ConditionExpression="attribute_not_exists(stitching)",
+            ExpressionAttributeValues={":w": {"S": WORKER_ID}},
         )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        print(f"[WORKER] Job {job_id} is already being stitched elsewhere.")
+        return
+
+    prefix = segment_prefix(user, job_id)
+    list_path = os.path.join(work_dir, "concat.txt")
+    try:
+        with open(list_path, "w") as f:
+            for seg in range(total):
+                url = s3.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": S3_BUCKET, "Key": f"{prefix}/enc_{seg:04d}.mp4"},
+                    ExpiresIn=STREAM_URL_EXPIRY,
+                )
+                f.write(f"file '{url}'\n")
+
+        print(f"[WORKER] Stitching {total} segment(s) of job {job_id} → {output_key}")
+        cmd = [
+            "ffmpeg", "-y", "-nostdin",
+            "-f", "concat", "-safe", "0",
+            "-protocol_whitelist", "file,http,https,tcp,tls,crypto",
+            "-i", list_path,
+            "-c", "copy",
+            *output_args(None, output_key),
+        ]
+        with STAGE_SECONDS.time(stage="stitch"):
+            finish_ffmpeg([launch(cmd, stdout=subprocess.PIPE)], output_key)
+    except Exception:
+        # Let the retried message try again
+        dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key=_job_key(user, job_id),
+            UpdateExpression="REMOVE stitching",
+        )
+        raise
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+    complete_with_cache(user, job_id, output_key, cache_key)
+    delete_prefix(prefix)
+    print(f"[WORKER] ✅ Completed segmented job {job_id} for {user}")
+
+def delete_prefix(prefix):
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{prefix}/"):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": keys, "Quiet": True})
+
+# ---------------- S3 INGEST ----------------
+# The bucket's ObjectCreated notifications for uploads/ arrive on the main queue. An upload
+# becomes an upload row, a queued job and a message on its size-class queue,
+# with the job details read from the key and the object's metadata.
+def s3_records(body):
+    """(bucket, key) of every ObjectCreated record in an S3 notification."""
+    return [
+        (r["s3"]["bucket"]["name"], unquote_plus(r["s3"]["object"]["key"]))
+        for r in body.get("Records", [])
+        if r.get("eventSource") == "aws:s3" and r.get("eventName", "").startswith("ObjectCreated:")
+    ]
+
+def _put_new(table, item, key_name):
+    """put_item unless the row exists; returns False if it did."""
+    try:
+        dynamodb.put_item(TableName=table, Item=item, ConditionExpression=f"attribute_not_exists({key_name})")
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def ingest_upload(bucket, key):
+    """Create the rows for a new upload and enqueue its job; returns the job id, or None if skipped."""
+    # The notification is filtered to uploads/, but keep the check in case it isn't
+    if not jobrecords.UPLOAD_KEY.match(key):
+        return None
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None  # deleted since (rejected upload or job deleted)
+        raise
+    user, file_id, filename, imdb_id, output_format = jobrecords.parse_upload(key, head.get("Metadata", {}))
+    job_id = jobrecords.job_id_for(file_id)
+
+    job = dynamodb.get_item(TableName=JOBS_TABLE, Key=_job_key(user, job_id), ConsistentRead=True).get("Item")
+    if job and "queued_at" in job:
+        print(f"[INGEST] Job {job_id} already queued - duplicate event.")
+        return None
+
+    if not job:
+        url = s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=300)
+        try:
+            with STAGE_SECONDS.time(stage="ingest_probe"):
+                media = probe_media(url)
+        except ProbeUnavailable as e:
+            # Says nothing about the file: keep it and let SQS redeliver the event
+            print(f"[INGEST] Could not probe {key}, will retry: {e}")
+            raise
+        except ProbeError as e:
+            # Confirmed unplayable. No upload response to report this on, so it shows as a failed job
+            s3.delete_object(Bucket=bucket, Key=key)
+            _put_new(JOBS_TABLE, {
+                **_job_key(user, job_id),
+                "file_id": {"S": file_id},
+                "filename": {"S": filename},
+                "s3_key": {"S": key},
+                "status": {"S": "failed"},
+                "error": {"S": f"Unplayable video rejected: {e}"},
+                "output_format": {"S": output_format},
+                "created": {"S": datetime.utcnow().isoformat()},
+            }, "jobs_id")
+            print(f"[INGEST] Rejected unplayable upload {key}: {e}")
+            return None
+        _put_new(UPLOADS_TABLE, jobrecords.upload_item(user, file_id, filename, key, imdb_id, media), "file_id")
+        job = jobrecords.job_item(user, file_id, filename, key, output_format, media)
+        if not _put_new(JOBS_TABLE, job, "jobs_id"):
+            # Created by /confirm-upload meanwhile: enqueue that row
+            job = dynamodb.get_item(TableName=JOBS_TABLE, Key=_job_key(user, job_id), ConsistentRead=True).get("Item")
+    if not job or job.get("status", {}).get("S") != "queued":
+        return None
+
+    try:
+        size_class = jobrecords.size_class(work=jobrecords.job_work(job))
+    except (KeyError, ValueError):
+        size_class = jobrecords.size_class(size_bytes=head["ContentLength"])
+    # Send before marking: a lost mark only risks a duplicate, which claim_job drops
+    sqs.send_message(QueueUrl=SQS_QUEUES[size_class], MessageBody=json.dumps(jobrecords.job_message(user, job)))
+    dynamodb.update_item(
+        TableName=JOBS_TABLE,
+        Key=_job_key(user, job_id),
+        UpdateExpression="SET queued_at=:t, size_class=:c",
+        ExpressionAttributeValues={":t": {"S": datetime.utcnow().isoformat()}, ":c": {"S": size_class}},
+    )
+    print(f"[INGEST] Queued job {job_id} ({size_class}) for {user}/{filename}")
+    return job_id
+
+# ---------------- QUEUE SCHEDULING ----------------
+# Smooth weighted round robin state and the last time each class was polled
+_wrr_current = {c: 0 for c in QUEUE_WEIGHTS}
+_last_polled = {c: time.monotonic() for c in QUEUE_WEIGHTS}
+
+def poll_order():
+    """Size classes in the order to try this cycle: starving classes, the weighted pick, then the rest."""
+    now = time.monotonic()
+    starving = sorted(
+        (c for c in QUEUE_WEIGHTS if now - _last_polled[c] > STARVATION_SECONDS),
+        key=_last_polled.get,
+    )
+
+    total = sum(QUEUE_WEIGHTS.values())
+    for c, weight in QUEUE_WEIGHTS.items():
+        _wrr_current[c] += weight
+    pick = max(_wrr_current, key=_wrr_current.get)
+    _wrr_current[pick] -= total
 
+    order = starving + [pick] if pick not in starving else list(starving)
+    rest = sorted(QUEUE_WEIGHTS, key=QUEUE_WEIGHTS.get, reverse=True)
+    return order + [c for c in rest if c not in order]
+
+def receive_batch(max_messages):
+    """Receive from the first size-class queue in poll order that has messages.
+
+    Every queue but the last is short-polled; the last gets the full long poll,
+    so an idle worker makes one empty-ish cycle per SQS_WAIT_SECONDS.
+    """
+    order = poll_order()
+    for size_class in order:
+        queue_url = SQS_QUEUES[size_class]
+        with STAGE_SECONDS.time(stage="receive"):
+            resp = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=max_messages,
+                WaitTimeSeconds=SQS_WAIT_SECONDS if size_class == order[-1] else 0,
+                AttributeNames=["SentTimestamp"],
+            )
+        _last_polled[size_class] = time.monotonic()
         messages = resp.get("Messages", [])
-        if not messages:
-            time.sleep(2)
-            continue
+        if messages:
+            for msg in messages:
+                msg["QueueUrl"] = queue_url
+                msg["SizeClass"] = size_class
+            return messages
+    return []
 
-        for msg in messages:
-            try:
-                body = json.loads(msg["Body"])
-                print("------------------------------------------------------------")
-                print("[DEBUG] Received message:", json.dumps(body, indent=2))
+def delete_msg(msg):
+    sqs.delete_message(QueueUrl=msg.get("QueueUrl", SQS_QUEUE_URL), ReceiptHandle=msg["ReceiptHandle"])
 
-                # Ignore random S3-trigger events
-                if "bucket" in body and "action" in body:
-                    print("[WORKER] Ignored S3-trigger message.")
-                    sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=msg["ReceiptHandle"])
-                    continue
+# ---------------- JOB HANDLER ----------------
+def process_message(msg):
+    """Run one SQS message end to end: download, transcode, upload, update DynamoDB."""
+    claimed = None
+    outcome = None
+    work_dir = None
+    started = time.monotonic()
+    sent = msg.get("Attributes", {}).get("SentTimestamp")
+    if sent:
+        QUEUE_WAIT_SECONDS.observe(max(0.0, time.time() - int(sent) / 1000), size_class=msg.get("SizeClass", "medium"))
+    try:
+        body = json.loads(msg["Body"])
+        print("------------------------------------------------------------")
+        print("[DEBUG] Received message:", json.dumps(body, indent=2))
 
-                # Extract job info
-                user = body.get("username") or body.get("cognito:username")
-                job_id = body.get("jobs_id")
-                s3_key = body.get("s3_key")
+        # S3 ObjectCreated notifications: turn new uploads into queued jobs
+        if "Records" in body or body.get("Event") == "s3:TestEvent":
+            for bucket, key in s3_records(body):
+                ingest_upload(bucket, key)
+            delete_msg(msg)
+            outcome = "ingested"
+            return
 
-                if not all([user, job_id, s3_key]):
-                    raise ValueError(f"Incomplete message data: {body}")
+        # Ignore random S3-trigger events
+        if "bucket" in body and "action" in body:
+            print("[WORKER] Ignored S3-trigger message.")
+            delete_msg(msg)
+            outcome = "ignored"
+            return
 
-                print(f"[WORKER] Processing job {job_id} for {user}")
+        # Segment sub-jobs of a split job (no claim, segments are idempotent)
+        if body.get("type") == "segment":
+            work_dir = scratch.job_dir(msg["DeliveryId"])
+            handle_segment(body, work_dir)
+            delete_msg(msg)
+            outcome = "segment"
+            return
 
-                # Mark job as 'processing'
-                dynamodb.update_item(
-                    TableName=JOBS_TABLE,
-                    Key={"qut-username": {"S": user}, "jobs_id": {"S": job_id}},
-                    UpdateExpression="SET #s=:s, started=:t",
-                    ExpressionAttributeNames={"#s": "status"},
-                    ExpressionAttributeValues={
-                        ":s": {"S": "processing"},
-                        ":t": {"S": datetime.utcnow().isoformat()},
-                    },
-                )
+        # Extract job info
+        user = body.get("username") or body.get("cognito:username")
+        job_id = body.get("jobs_id")
+        s3_key = body.get("s3_key")
 
-                # Download source video
-                filename = os.path.basename(s3_key)
-                input_path = f"/tmp/{filename}"
-                output_path = f"/tmp/transcoded_{filename}"
-                s3.download_file(S3_BUCKET, s3_key, input_path)
+        if not all([user, job_id, s3_key]):
+            raise ValueError(f"Incomplete message data: {body}")
 
-                # Uncomment below to test DLQ behaviour
-                # raise Exception("Simulated failure for DLQ test")
+        print(f"[WORKER] Processing job {job_id} for {user}")
 
-                # Run FFmpeg
-                run_ffmpeg(input_path, output_path)
+        # Claim the job (marks it 'processing'); duplicates are dropped here
+        token = new_claim_token()
+        if not claim_job(user, job_id, token):
+            print(f"[WORKER] Job {job_id} already completed or claimed elsewhere - dropping duplicate.")
+            delete_msg(msg)
+            outcome = "duplicate"
+            return
+        claimed = (user, job_id, token)
+        with in_flight_lock:
+            if msg["DeliveryId"] in in_flight_msgs:
+                in_flight_msgs[msg["DeliveryId"]].update(job=(user, job_id), token=token)
+        # Only the claim holder gets a work dir, so a losing duplicate can't clean it up
+        work_dir = scratch.job_dir(token)
 
-                # Upload finished video
-                output_s3_key = f"{user}/transcoded_{filename}"
-                s3.upload_file(output_path, S3_BUCKET, output_s3_key)
+        # Identical source + settings already transcoded: share that output, skip the work
+        output_format = body.get("output_format", "mp4")
+        cache_key = result_cache_key(s3_key, output_format) if RESULT_CACHE else None
+        cached_output = acquire_cached_output(cache_key) if cache_key else None
+        if cached_output:
+            finish_job(user, job_id, cached_output, cache_key)
+            delete_msg(msg)
+            print(f"[WORKER] ✅ Cache hit for job {job_id} → {cached_output}")
+            outcome = "cache_hit"
+            return
 
-                # Mark as completed
-                dynamodb.update_item(
-                    TableName=JOBS_TABLE,
-                    Key={"qut-username": {"S": user}, "jobs_id": {"S": job_id}},
-                    UpdateExpression="SET #s=:s, finished=:f",
-                    ExpressionAttributeNames={"#s": "status"},
-                    ExpressionAttributeValues={
-                        ":s": {"S": "completed"},
-                        ":f": {"S": datetime.utcnow().isoformat()},
-                    },
-                )
+        # Source video: stream straight from S3, or from the local scratch cache
+        filename = os.path.basename(s3_key)
+        output_path = os.path.join(work_dir, f"transcoded_{filename}")
+        output_s3_key = f"{user}/transcoded_{filename}"
+        input_path = source_input(s3_key, work_dir)
+
+        # Uncomment below to test DLQ behaviour
+        # raise Exception("Simulated failure for DLQ test")
+
+        # Duration comes from the upload-time probe when available
+        duration = float(body.get("duration") or 0) or probe_duration(input_path)
 
-                # Delete from queue once done
-                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=msg["ReceiptHandle"])
-                print(f"[WORKER] ✅ Completed job {job_id} for {user}")
+        # Adaptive bitrate jobs: one decode, full HLS rendition ladder
+        if output_format == "hls":
+            progress = ProgressReporter(dynamodb, JOBS_TABLE, _job_key(user, job_id), duration)
+            complete_with_cache(user, job_id, run_abr_ladder(input_path, user, job_id, work_dir, progress), cache_key)
+            delete_msg(msg)
+            print(f"[WORKER] ✅ Completed HLS job {job_id} for {user}")
+            outcome = "completed"
+            return
 
-            except ValueError as e:
-                # Skip bad messages
-                print(f"[WORKER] Malformed message: {e}")
-                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=msg["ReceiptHandle"])
+        # Long videos fan out to segment sub-jobs instead of running here
+        if SEGMENTED_MODE and duration >= SEGMENT_MIN_DURATION:
+            split_job(user, job_id, input_path, output_s3_key, work_dir, cache_key, msg.get("QueueUrl", SQS_QUEUE_URL))
+            delete_msg(msg)
+            outcome = "split"
+            return
 
-            except Exception as e:
-                # Let SQS handle retries / DLQ
-                print(f"[WORKER] Error processing job: {e}")
-                traceback.print_exc()
-                print("[WORKER] Message left for retry or DLQ transfer.")
+        # Run FFmpeg and upload the finished video (overlapped when streaming)
+        passes = 1 if TRANSCODE_MODE == "single" else TRANSCODE_PASSES
+        progress = ProgressReporter(dynamodb, JOBS_TABLE, _job_key(user, job_id), duration, passes)
+        with STAGE_SECONDS.time(stage="transcode"):
+            if OUTPUT_MODE == "stream":
+                run_ffmpeg(input_path, output_path, upload_key=output_s3_key, progress=progress)
+            else:
+                run_ffmpeg(input_path, output_path, progress=progress)
+        if progress.latest.get("fps"):
+            ENCODE_FPS.observe(progress.latest["fps"])
+        if OUTPUT_MODE != "stream":
+            with STAGE_SECONDS.time(stage="upload"):
+                s3.upload_file(output_path, S3_BUCKET, output_s3_key)
+            BYTES_MOVED.inc(os.path.getsize(output_path), direction="upload")
+
+        # Mark as completed
+        complete_with_cache(user, job_id, output_s3_key, cache_key)
+
+        # Delete from queue once done
+        delete_msg(msg)
+        print(f"[WORKER] ✅ Completed job {job_id} for {user}")
+        outcome = "completed"
+
+    except ValueError as e:
+        # Skip bad messages
+        print(f"[WORKER] Malformed message: {e}")
+        delete_msg(msg)
+        outcome = "malformed"
 
-    except KeyboardInterrupt:
-        print("Worker stopped manually.")
-        break
     except Exception as e:
-        # Catch any loop-level errors
-        print(f"[WORKER] Global error: {e}")
-        time.sleep(5)
+        # Let SQS handle retries / DLQ
+        print(f"[WORKER] Error processing job: {e}")
+        traceback.print_exc()
+        if claimed:
+            release_job(*claimed)
+        print("[WORKER] Message left for retry or DLQ transfer.")
+        outcome = "failed"
+
+    finally:
+        if work_dir:
+            scratch.cleanup_job(work_dir)
+        if outcome:
+            JOBS_TOTAL.inc(outcome=outcome)
+            STAGE_SECONDS.observe(time.monotonic() - started, stage="message_total")
+        with in_flight_lock:
+            in_flight_msgs.pop(msg.get("DeliveryId"), None)
+
+# ---------------- MAIN WORKER LOOP ----------------
+def main():
+    global scratch
+    scratch = ScratchArea(SCRATCH_DIR, SCRATCH_QUOTA_BYTES)
+    pool = ThreadPoolExecutor(max_workers=WORKER_SLOTS, thread_name_prefix="slot")
+    in_flight = set()
+    print(f"[WORKER] Started {WORKER_ID} with {WORKER_SLOTS} job slot(s), ffmpeg threads={FFMPEG_THREADS}, mode={TRANSCODE_MODE}, input={INPUT_MODE}, output={OUTPUT_MODE}, segmented={SEGMENTED_MODE}")
+    threading.Thread(target=heartbeat_loop, name="heartbeat", daemon=True).start()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        print(f"[WORKER] Metrics on http://0.0.0.0:{METRICS_PORT}/metrics")
+
+    while True:
+        try:
+            # Only ask SQS for as many messages as we have free slots
+            in_flight = {f for f in in_flight if not f.done()}
+            free_slots = WORKER_SLOTS - len(in_flight)
+            if free_slots <= 0:
+                time.sleep(1)
+                continue
+
+            # Poll the size-class queues by weighted priority (SentTimestamp feeds the queue wait metric)
+            messages = receive_batch(min(free_slots, SQS_MAX_BATCH))
+            if not messages:
+                continue
+
+            for msg in messages:
+                msg["DeliveryId"] = uuid.uuid4().hex
+                with in_flight_lock:
+                    in_flight_msgs[msg["DeliveryId"]] = {"receipt": msg["ReceiptHandle"], "queue": msg["QueueUrl"], "job": None}
+                in_flight.add(pool.submit(process_message, msg))
+
+        except KeyboardInterrupt:
+            print("Worker stopped manually.")
+            break
+        except Exception as e:
+            # Catch any loop-level errors
+            print(f"[WORKER] Global error: {e}")
+            time.sleep(5)
+
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()